@@ -13,14 +13,31 @@ This version is the FINAL, STABLE build. It includes:
 # --- Core Python Imports ---
 import logging
 import os
-import requests  # <-- The stable, synchronous library
+import httpx  # <-- Async, pooled HTTP client (also used by python-telegram-bot)
 import json
-import asyncio  # <-- For the asyncio.run() fix
+import html
+import asyncio
+import queue
 import base64
+import hashlib
+import unicodedata
 import io
 import wave
 import struct
+import re
+import shutil
 import threading
+from collections import OrderedDict
+import time
+import random
+import atexit
+import socket
+import uuid
+import contextvars
+import cProfile
+import pstats
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps # <-- NEW for dashboard login
 
 # --- Telegram Imports ---
@@ -35,13 +52,16 @@ from telegram.ext import (
     CallbackQueryHandler
 )
 from telegram.constants import ParseMode, ChatType
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, RetryAfter
 
 # --- Flask & Server Imports ---
-from flask import Flask, request as flask_request, render_template_string, redirect, url_for, session, jsonify, make_response
+from flask import Flask, Blueprint, request as flask_request, render_template_string, redirect, url_for, session, jsonify, make_response
 from flask_bcrypt import Bcrypt # <-- NEW for password hashing
 from flask_session import Session # <-- NEW for login sessions
 import pymongo
+from pymongo import monitoring
+from bson import ObjectId
+from PIL import Image
 import gunicorn # <-- We have this in requirements, but good to import
 
 # --- CONFIGURATION (from Render Environment Variables) ---
@@ -57,6 +77,172 @@ except (ValueError, TypeError):
     print("FATAL: ADMIN_USER_ID is not set or invalid.")
     ADMIN_USER_ID = 0
 
+try:
+    LOG_CHANNEL_ID = int(os.environ.get("LOG_CHANNEL_ID"))
+except (ValueError, TypeError):
+    LOG_CHANNEL_ID = None  # channel logging disabled
+
+# --- DATABASE HEALTH TUNING ---
+# How long a heartbeat result is trusted before the watchdog pings on its own.
+DB_HEALTH_TTL = float(os.environ.get("DB_HEALTH_TTL", "30"))
+DB_HEARTBEAT_FREQUENCY_MS = int(os.environ.get("DB_HEARTBEAT_FREQUENCY_MS", "10000"))
+DB_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("DB_BREAKER_FAILURE_THRESHOLD", "3"))
+DB_BREAKER_COOLDOWN = float(os.environ.get("DB_BREAKER_COOLDOWN", "20"))
+
+# --- HOT CONFIG CACHE TUNING ---
+# Full reload interval used as a safety net even when the change stream is live.
+HOT_CONFIG_TTL = float(os.environ.get("HOT_CONFIG_TTL", "300"))
+# Version-counter poll interval used when change streams are unavailable.
+HOT_CONFIG_POLL_INTERVAL = float(os.environ.get("HOT_CONFIG_POLL_INTERVAL", "15"))
+
+# --- MONGODB POOL / EXECUTOR SETTINGS ---
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "2"))
+# Threads that run pymongo calls for the async handlers; keep <= MONGO_MAX_POOL_SIZE.
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", "16"))
+
+# --- WRITE-BEHIND SETTINGS (log_user upserts + chat_logs audit trail) ---
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL", "2"))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_MAX_USERS = int(os.environ.get("WRITE_BEHIND_MAX_USERS", "10000"))
+WRITE_BEHIND_MAX_LOGS = int(os.environ.get("WRITE_BEHIND_MAX_LOGS", "20000"))
+# How long a producer may wait for room in a full buffer before its entry is dropped.
+WRITE_BEHIND_BLOCK_TIMEOUT = float(os.environ.get("WRITE_BEHIND_BLOCK_TIMEOUT", "0.25"))
+
+# --- CHAT HISTORY CACHE SETTINGS ---
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", "1000"))  # chats kept in memory
+HISTORY_CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", "120"))
+
+# --- CONTEXT BUILDER SETTINGS ---
+# Max estimated input tokens per chat request (history + summary + new turn).
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "6000"))
+# Gemini 2.x counts an image with both sides <= 384 px as 258 tokens and cuts
+# larger ones into 768x768 tiles of 258 tokens each (see IMAGE_TOKEN_ESTIMATE).
+IMAGE_TILE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+
+# --- BROADCAST SETTINGS ---
+# Telegram allows ~30 messages/second per bot; stay a little under it.
+BROADCAST_RATE_PER_SEC = float(os.environ.get("BROADCAST_RATE_PER_SEC", "25"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+# Users fetched (and progress checkpointed) per batch.
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "200"))
+# A worker owns a running job until its lease expires. A heartbeat renews it
+# every quarter of this while the job runs (flood-control pauses included), and
+# the worker stops sending once it has gone 3/4 of it without a renewal.
+BROADCAST_LEASE_SECONDS = float(os.environ.get("BROADCAST_LEASE_SECONDS", "120"))
+# Identifies this process as a broadcast job owner (pids repeat across containers).
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# --- STREAMING REPLY SETTINGS ---
+# Minimum seconds between edits of a streamed reply (Telegram throttles edits per chat).
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.2"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# --- MEDIA CACHE SETTINGS (/say audio, /send_image portraits) ---
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", "/tmp/ananya_media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+PORTRAIT_POOL_SIZE = int(os.environ.get("PORTRAIT_POOL_SIZE", "4"))
+# A pooled portrait is retired (and replaced in the background) after this many sends.
+PORTRAIT_MAX_USES = int(os.environ.get("PORTRAIT_MAX_USES", "50"))
+ANANYA_PORTRAIT_PROMPT = (
+    "A photorealistic portrait of Ananya, a friendly and charming young Indian woman in her early twenties "
+    "with long dark hair and a warm smile, wearing casual modern clothes, soft natural lighting, "
+    "shallow depth of field, high detail."
+)
+
+# --- TTS PIPELINE SETTINGS ---
+TTS_CHUNK_CHARS = int(os.environ.get("TTS_CHUNK_CHARS", "400"))
+TTS_SAMPLE_RATE = 24000  # Gemini TTS returns 16-bit mono PCM at 24 kHz
+TTS_OPUS_BITRATE = os.environ.get("TTS_OPUS_BITRATE", "32k")
+# ffmpeg (with libopus) turns PCM into Telegram voice notes; without it /say falls back to WAV.
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH") or shutil.which("ffmpeg")
+
+# --- WEBHOOK INGESTION SETTINGS ---
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_CONCURRENCY = int(os.environ.get("WEBHOOK_CONCURRENCY", "64"))  # updates processed at once
+WEBHOOK_DEDUP_SIZE = int(os.environ.get("WEBHOOK_DEDUP_SIZE", "10000"))  # recent update_ids remembered
+# After a failed startup (e.g. getMe timing out), the next webhook retries it
+# once this backoff has passed; it doubles per failure up to the max.
+WEBHOOK_STARTUP_RETRY_MIN = float(os.environ.get("WEBHOOK_STARTUP_RETRY_MIN", "1"))
+WEBHOOK_STARTUP_RETRY_MAX = float(os.environ.get("WEBHOOK_STARTUP_RETRY_MAX", "60"))
+# Optional; must match the secret_token passed to setWebhook.
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN")
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL")  # e.g. a local Bot API server; default is api.telegram.org
+
+# --- JOB SCHEDULER SETTINGS ---
+# Concurrent jobs and max queued+running jobs per job class.
+SCHEDULER_WORKERS = {
+    "text": int(os.environ.get("SCHEDULER_TEXT_WORKERS", "32")),
+    "vision": int(os.environ.get("SCHEDULER_VISION_WORKERS", "8")),
+    "tts": int(os.environ.get("SCHEDULER_TTS_WORKERS", "4")),
+    "image": int(os.environ.get("SCHEDULER_IMAGE_WORKERS", "2")),
+}
+SCHEDULER_QUEUE_LIMITS = {
+    "text": int(os.environ.get("SCHEDULER_TEXT_QUEUE", "500")),
+    "vision": int(os.environ.get("SCHEDULER_VISION_QUEUE", "100")),
+    "tts": int(os.environ.get("SCHEDULER_TTS_QUEUE", "40")),
+    "image": int(os.environ.get("SCHEDULER_IMAGE_QUEUE", "20")),
+}
+# Per-user token bucket: sustained jobs per second and burst size.
+USER_RATE_PER_SEC = float(os.environ.get("USER_RATE_PER_SEC", "0.5"))
+USER_RATE_BURST = float(os.environ.get("USER_RATE_BURST", "5"))
+
+# --- STATS SETTINGS ---
+# How often each worker recounts the collections to correct counter drift.
+STATS_RECONCILE_INTERVAL = float(os.environ.get("STATS_RECONCILE_INTERVAL", str(24 * 3600)))
+
+# --- CHAT LOG STORE SETTINGS ---
+# chat_logs entries older than this are removed by a TTL index (0 keeps them forever).
+LOG_RETENTION_DAYS = int(os.environ.get("LOG_RETENTION_DAYS", "90"))
+LOG_PAGE_SIZE = 20
+# Entries fetched per page at most; a page also stops early once the rendered
+# text would pass TELEGRAM_MESSAGE_LIMIT.
+LOG_MAX_PAGE_SIZE = 50
+
+# --- LOG CHANNEL SINK SETTINGS ---
+LOG_SINK_MAX_EVENTS = int(os.environ.get("LOG_SINK_MAX_EVENTS", "500"))  # non-error events buffered
+LOG_CHANNEL_RATE_PER_MIN = float(os.environ.get("LOG_CHANNEL_RATE_PER_MIN", "18"))  # Telegram allows ~20/min per channel
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.1"))  # share of chat messages mirrored to the channel
+
+# --- VISION IMAGE PREPROCESSING SETTINGS ---
+VISION_MAX_EDGE = int(os.environ.get("VISION_MAX_EDGE", "1024"))  # longest side sent to Gemini, in pixels
+VISION_IMAGE_FORMAT = os.environ.get("VISION_IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+VISION_IMAGE_QUALITY = int(os.environ.get("VISION_IMAGE_QUALITY", "80"))
+# Worst case for an image downscaled to VISION_MAX_EDGE (a square one), so the
+# context budget never under-counts a photo: 1024 px -> 2x2 tiles -> 1032 tokens.
+IMAGE_TOKEN_ESTIMATE = (
+    IMAGE_TILE_TOKENS if VISION_MAX_EDGE <= 384
+    else IMAGE_TILE_TOKENS * (-(-VISION_MAX_EDGE // 768)) ** 2
+)
+
+# --- FORCE-JOIN MEMBERSHIP CACHE SETTINGS ---
+MEMBERSHIP_POSITIVE_TTL = int(os.environ.get("MEMBERSHIP_POSITIVE_TTL", "21600"))  # seconds a "joined" result is trusted
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get("MEMBERSHIP_NEGATIVE_TTL", "60"))  # short, so users who just joined get through
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get("MEMBERSHIP_CACHE_SIZE", "50000"))  # in-process entries
+
+# --- METRICS & TRACING SETTINGS ---
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # if set, /metrics requires "Authorization: Bearer <token>"
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))  # share of requests whose spans are logged
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "3000"))  # slower requests are always logged
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "40"))  # rows in an /admin_profile report
+
+# --- GEMINI API SETTINGS ---
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_TEXT_MODEL = os.environ.get("GEMINI_TEXT_MODEL", "gemini-2.5-flash-preview-09-2025")
+GEMINI_VISION_MODEL = os.environ.get("GEMINI_VISION_MODEL", GEMINI_TEXT_MODEL)
+GEMINI_TTS_MODEL = os.environ.get("GEMINI_TTS_MODEL", "gemini-2.5-flash-preview-tts")
+GEMINI_IMAGE_MODEL = os.environ.get("GEMINI_IMAGE_MODEL", "gemini-3-pro-image-preview")
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "3"))
+GEMINI_MAX_CONNECTIONS = int(os.environ.get("GEMINI_MAX_CONNECTIONS", "32"))
+# Per-endpoint (model, timeout seconds, max concurrent calls)
+GEMINI_ENDPOINTS = {
+    "text": (GEMINI_TEXT_MODEL, float(os.environ.get("GEMINI_TEXT_TIMEOUT", "60")), int(os.environ.get("GEMINI_TEXT_CONCURRENCY", "16"))),
+    "vision": (GEMINI_VISION_MODEL, float(os.environ.get("GEMINI_VISION_TIMEOUT", "90")), int(os.environ.get("GEMINI_VISION_CONCURRENCY", "8"))),
+    "tts": (GEMINI_TTS_MODEL, float(os.environ.get("GEMINI_TTS_TIMEOUT", "120")), int(os.environ.get("GEMINI_TTS_CONCURRENCY", "4"))),
+    "image": (GEMINI_IMAGE_MODEL, float(os.environ.get("GEMINI_IMAGE_TIMEOUT", "180")), int(os.environ.get("GEMINI_IMAGE_CONCURRENCY", "2"))),
+}
+
 # --- VERIFICATION GROUP/CHANNEL ---
 GROUP_USERNAME = "@ananyabotchat"
 CHANNEL_USERNAME = "@ananyabotupdates"
@@ -104,9 +290,290 @@ logging.getLogger("telegram.ext").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+# --- LATENCY HISTOGRAMS ---
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (seconds) with approximate percentiles."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        with self._lock:
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket containing the q-th quantile (0 < q <= 1)."""
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            target = q * self.count
+            running = 0
+            for bound, bucket_count in zip(self.BUCKETS, self.counts):
+                running += bucket_count
+                if running >= target:
+                    return bound
+            return self.BUCKETS[-1]
+
+    def cumulative(self) -> tuple:
+        """([(bucket_bound, cumulative_count), ...], count, total) for Prometheus."""
+        with self._lock:
+            running, buckets = 0, []
+            for bound, bucket_count in zip(self.BUCKETS, self.counts):
+                running += bucket_count
+                buckets.append((bound, running))
+            return buckets, self.count, self.total
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": (self.total / self.count * 1000) if self.count else 0.0,
+            "p50_ms": self.percentile(0.50) * 1000,
+            "p95_ms": self.percentile(0.95) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+        }
+
+
+# --- REQUEST TRACE SPANS ---
+# Handlers wrapped in track_latency collect (name, seconds) spans from run_db
+# and the Gemini client while they run; tasks they spawn share the same list.
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def record_span(name: str, seconds: float):
+    trace = _current_trace.get()
+    if trace is not None and len(trace) < 200:
+        trace.append((name, seconds))
+
+def log_trace(handler_name: str, elapsed: float, spans: list):
+    parts = ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in spans)
+    logger.info(f"trace {handler_name} total={elapsed * 1000:.0f}ms spans=[{parts}]")
+
+
+# --- MONGODB CONNECTION HEALTH ---
+class DBHealthMonitor(monitoring.ServerHeartbeatListener, monitoring.TopologyListener):
+    """
+    Tracks MongoDB health from pymongo's own heartbeat/topology events so the
+    DB helpers can ask "is the database usable?" without a network round-trip.
+
+    The state is one of "unknown", "healthy", "degraded" or "down", and a small
+    circuit breaker (closed -> open -> half_open) decides whether helpers may
+    touch the database at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._watchdog = None
+        self._ping_in_flight = False
+        self.state = "unknown"
+        self.breaker = "closed"
+        self.breaker_opened_at = 0.0
+        self.consecutive_failures = 0
+        self.last_event_at = 0.0
+        self.last_error = None
+        self.last_ping_ms = None
+        self.avg_ping_ms = None
+        self.heartbeats_ok = 0
+        self.heartbeats_failed = 0
+        self.pings = 0
+        self.ping_failures = 0
+        self.breaker_trips = 0
+
+    # --- pymongo event hooks (called from pymongo's monitor threads) ---
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        # Awaited (streaming) heartbeats include the server-side wait, so their
+        # duration is not a round-trip time.
+        latency_ms = None if getattr(event, "awaited", False) else event.duration * 1000
+        with self._lock:
+            self.heartbeats_ok += 1
+        self._record_success(latency_ms)
+
+    def failed(self, event):
+        with self._lock:
+            self.heartbeats_failed += 1
+        self._record_failure(event.reply)
+
+    def opened(self, event):
+        pass
+
+    def description_changed(self, event):
+        new_description = event.new_description
+        if new_description.has_writable_server():
+            self._record_success(None)
+        elif new_description.has_readable_server():
+            with self._lock:
+                self.state = "degraded"
+                self.last_event_at = time.monotonic()
+        else:
+            self._record_failure("No writable or readable server in topology.")
+
+    def closed(self, event):
+        pass
+
+    # --- State transitions ---
+    def _record_success(self, latency_ms):
+        with self._lock:
+            self.last_event_at = time.monotonic()
+            self.consecutive_failures = 0
+            self.state = "healthy"
+            if latency_ms is not None:
+                self.last_ping_ms = latency_ms
+                if self.avg_ping_ms is None:
+                    self.avg_ping_ms = latency_ms
+                else:
+                    self.avg_ping_ms = 0.8 * self.avg_ping_ms + 0.2 * latency_ms
+            if self.breaker != "closed":
+                logger.info("Database recovered, closing circuit breaker.")
+                self.breaker = "closed"
+
+    def _record_failure(self, error):
+        with self._lock:
+            self.last_event_at = time.monotonic()
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            self.state = "degraded"
+            if (
+                self.breaker == "half_open"
+                or self.consecutive_failures >= DB_BREAKER_FAILURE_THRESHOLD
+            ):
+                self.state = "down"
+                if self.breaker != "open":
+                    self.breaker_trips += 1
+                    logger.error(f"Database circuit breaker OPEN: {error}")
+                self.breaker = "open"
+                self.breaker_opened_at = time.monotonic()
+
+    # --- Public API ---
+    def allow_request(self) -> bool:
+        """Cheap, I/O-free check used by every DB helper."""
+        with self._lock:
+            if self.breaker == "open":
+                if time.monotonic() - self.breaker_opened_at < DB_BREAKER_COOLDOWN:
+                    return False
+                # Let traffic probe the database again; the next heartbeat or
+                # ping decides whether the breaker closes or re-opens.
+                self.breaker = "half_open"
+            stale = time.monotonic() - self.last_event_at > DB_HEALTH_TTL
+        if stale:
+            self.request_ping()
+        return True
+
+    def request_ping(self):
+        """Schedules a background ping unless one is already running."""
+        with self._lock:
+            if self._ping_in_flight or self._client is None:
+                return
+            self._ping_in_flight = True
+        threading.Thread(target=self._ping, name="db-health-ping", daemon=True).start()
+
+    def _ping(self):
+        start = time.perf_counter()
+        try:
+            self._client.admin.command("ping")
+            with self._lock:
+                self.pings += 1
+            self._record_success((time.perf_counter() - start) * 1000)
+        except Exception as e:
+            with self._lock:
+                self.pings += 1
+                self.ping_failures += 1
+            self._record_failure(e)
+        finally:
+            with self._lock:
+                self._ping_in_flight = False
+
+    def _watchdog_loop(self):
+        while True:
+            time.sleep(max(DB_HEALTH_TTL / 2, 1))
+            with self._lock:
+                stale = time.monotonic() - self.last_event_at > DB_HEALTH_TTL
+            if stale:
+                self.request_ping()
+
+    def start(self, mongo_client):
+        """Attaches the monitor to a client and starts the staleness watchdog."""
+        self._client = mongo_client
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(
+                target=self._watchdog_loop, name="db-health-watchdog", daemon=True
+            )
+            self._watchdog.start()
+
+    def stats(self) -> dict:
+        """Snapshot of health counters for the dashboard."""
+        with self._lock:
+            age = time.monotonic() - self.last_event_at if self.last_event_at else None
+            return {
+                "state": self.state,
+                "breaker": self.breaker,
+                "breaker_trips": self.breaker_trips,
+                "consecutive_failures": self.consecutive_failures,
+                "last_ping_ms": self.last_ping_ms,
+                "avg_ping_ms": self.avg_ping_ms,
+                "heartbeats_ok": self.heartbeats_ok,
+                "heartbeats_failed": self.heartbeats_failed,
+                "pings": self.pings,
+                "ping_failures": self.ping_failures,
+                "last_event_age_s": age,
+                "last_error": self.last_error,
+            }
+
+
+db_health = DBHealthMonitor()
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every command pymongo sends (find, update, insert, ...) for /metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}  # command name -> LatencyHistogram
+        self.failures = {}  # command name -> count
+
+    def _histogram(self, command_name: str) -> LatencyHistogram:
+        histogram = self.latency.get(command_name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.latency.setdefault(command_name, LatencyHistogram())
+        return histogram
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._histogram(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self._histogram(event.command_name).observe(event.duration_micros / 1e6)
+        with self._lock:
+            self.failures[event.command_name] = self.failures.get(event.command_name, 0) + 1
+
+
+mongo_commands = MongoCommandTimer()
+
+
 # --- MONGODB DATABASE SETUP ---
 try:
-    client = pymongo.MongoClient(MONGODB_URI, serverSelectionTimeoutMS=5000)
+    client = pymongo.MongoClient(
+        MONGODB_URI,
+        serverSelectionTimeoutMS=5000,
+        heartbeatFrequencyMS=DB_HEARTBEAT_FREQUENCY_MS,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        event_listeners=[db_health, mongo_commands],
+    )
     db = client.ananya_bot
     users_col = db.users
     blocked_col = db.blocked_users
@@ -114,7 +581,14 @@ try:
     history_col = db.chat_history
     prompts_col = db.prompts
     status_col = db.bot_status # <-- NEW: For the on/off switch
+    logs_col = db.chat_logs
+    jobs_col = db.broadcast_jobs
+    media_col = db.media_cache
+    stats_col = db.bot_stats
+    stats_daily_col = db.stats_daily
+    membership_col = db.membership_cache
     logger.info("MongoDB client created and collections initialized.")
+    db_health.start(client)
 except Exception as e:
     logger.error(f"FATAL: Could not create MongoDB client: {e}")
     client = None
@@ -125,6 +599,12 @@ except Exception as e:
     history_col = None
     prompts_col = None
     status_col = None
+    logs_col = None
+    jobs_col = None
+    media_col = None
+    stats_col = None
+    stats_daily_col = None
+    membership_col = None
 
 # --- MONGODB DATABASE FUNCTIONS ---
 def is_db_connected():
@@ -140,13 +620,223 @@ def is_db_connected():
     ):
         logger.error("Database client is not configured.")
         return False
-    # Test connection
-    try:
-        client.server_info()
-        return True
-    except Exception as e:
-        logger.error(f"Database connection test failed: {e}")
-        return False
+    # No round-trip here: the health monitor keeps this up to date from
+    # pymongo heartbeats and its own background pings.
+    return db_health.allow_request()
+
+def get_db_health_stats() -> dict:
+    """Connection health counters (ping latency, breaker trips, ...) for the dashboard."""
+    return db_health.stats()
+
+# --- HOT CONFIG CACHE (bot on/off, blocklist, personality prompts) ---
+class HotConfigCache:
+    """
+    In-process, read-through copy of the small config collections that are
+    consulted on every message: the global on/off flag, the set of blocked user
+    IDs and the DB personality prompts.
+
+    After the first load, reads never touch MongoDB. The cache is kept fresh by
+    a change stream on the three collections; if the deployment does not
+    support change streams it polls a version counter instead. A full reload
+    every HOT_CONFIG_TTL seconds is the safety net in both modes. Local writes
+    go through write_* methods so this worker sees them immediately.
+    """
+
+    VERSION_DOC_ID = "config_version"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watcher = None
+        self._refreshing = False
+        self.bot_on = None  # None: no status document in the DB yet
+        self.blocked_ids = frozenset()
+        self.prompts = {}
+        self.version = None
+        self.loaded_at = 0.0
+        self.change_stream_active = False
+        self.reloads = 0
+        self.events_applied = 0
+
+    # --- Loading ---
+    def _reload(self):
+        status = status_col.find_one({"_id": "global_status"})
+        version_doc = status_col.find_one({"_id": self.VERSION_DOC_ID})
+        blocked = frozenset(doc["_id"] for doc in blocked_col.find({}, {"_id": 1}))
+        prompts = {doc["_id"]: doc["prompt"] for doc in prompts_col.find({}, {"prompt": 1}) if "prompt" in doc}
+        with self._lock:
+            self.bot_on = None if status is None else status.get("is_on", True)
+            self.blocked_ids = blocked
+            self.prompts = prompts
+            self.version = version_doc.get("v") if version_doc else None
+            self.loaded_at = time.monotonic()
+            self.reloads += 1
+
+    def _ensure_loaded(self):
+        """Loads synchronously once, then only ever refreshes in the background."""
+        if self._ready.is_set():
+            if time.monotonic() - self.loaded_at > HOT_CONFIG_TTL:
+                self._refresh_in_background()
+            return
+        with self._load_lock:
+            if not self._ready.is_set():
+                self._reload()
+                self._ready.set()
+                self._start_watcher()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self._reload()
+            except Exception as e:
+                logger.error(f"Error refreshing hot config cache: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name="hot-config-refresh", daemon=True).start()
+
+    # --- Invalidation ---
+    def _start_watcher(self):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, name="hot-config-watch", daemon=True)
+            self._watcher.start()
+
+    def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": [
+            blocked_col.name, prompts_col.name, status_col.name,
+        ]}}}]
+        while True:
+            try:
+                with db.watch(pipeline, full_document="updateLookup") as stream:
+                    self.change_stream_active = True
+                    logger.info("Hot config cache is following the change stream.")
+                    # Anything written between the initial load and the stream
+                    # opening would otherwise be missed.
+                    self._reload()
+                    for change in stream:
+                        self._apply_change(change)
+            except pymongo.errors.OperationFailure as e:
+                # Standalone servers do not support change streams.
+                self.change_stream_active = False
+                logger.warning(f"Change streams unavailable ({e}); polling config version instead.")
+                self._poll_version()
+                return
+            except Exception as e:
+                self.change_stream_active = False
+                logger.error(f"Hot config change stream interrupted: {e}")
+                time.sleep(HOT_CONFIG_POLL_INTERVAL)
+
+    def _poll_version(self):
+        while True:
+            time.sleep(HOT_CONFIG_POLL_INTERVAL)
+            if not is_db_connected():
+                continue
+            try:
+                version_doc = status_col.find_one({"_id": self.VERSION_DOC_ID})
+                version = version_doc.get("v") if version_doc else None
+                if version != self.version:
+                    self._reload()
+            except Exception as e:
+                logger.error(f"Error polling hot config version: {e}")
+
+    def _apply_change(self, change: dict):
+        coll = change["ns"]["coll"]
+        op = change["operationType"]
+        doc_id = change.get("documentKey", {}).get("_id")
+        full_doc = change.get("fullDocument")
+        with self._lock:
+            if coll == blocked_col.name:
+                if op == "delete":
+                    self.blocked_ids = self.blocked_ids - {doc_id}
+                elif op in ("insert", "replace", "update"):
+                    self.blocked_ids = self.blocked_ids | {doc_id}
+            elif coll == prompts_col.name:
+                prompts = dict(self.prompts)
+                if op == "delete" or not full_doc or "prompt" not in full_doc:
+                    prompts.pop(doc_id, None)
+                else:
+                    prompts[doc_id] = full_doc["prompt"]
+                self.prompts = prompts
+            elif coll == status_col.name:
+                if doc_id == "global_status":
+                    self.bot_on = full_doc.get("is_on", True) if full_doc else None
+                elif doc_id == self.VERSION_DOC_ID and full_doc:
+                    self.version = full_doc.get("v")
+            self.events_applied += 1
+
+    def bump_version(self):
+        """Tells other workers (in polling mode) that the config changed."""
+        try:
+            status_col.update_one({"_id": self.VERSION_DOC_ID}, {"$inc": {"v": 1}}, upsert=True)
+        except Exception as e:
+            logger.error(f"Error bumping hot config version: {e}")
+
+    # --- Reads (no I/O after the first load) ---
+    def get_bot_on(self):
+        self._ensure_loaded()
+        return self.bot_on
+
+    def is_blocked(self, user_id_str: str) -> bool:
+        self._ensure_loaded()
+        return user_id_str in self.blocked_ids
+
+    def get_prompt(self, personality_name: str):
+        self._ensure_loaded()
+        return self.prompts.get(personality_name)
+
+    # --- Write-through ---
+    def write_bot_on(self, is_on: bool):
+        with self._lock:
+            self.bot_on = is_on
+
+    def write_blocked(self, user_id_str: str, blocked: bool):
+        with self._lock:
+            if blocked:
+                self.blocked_ids = self.blocked_ids | {user_id_str}
+            else:
+                self.blocked_ids = self.blocked_ids - {user_id_str}
+
+    def write_prompt(self, personality_name: str, prompt_text):
+        with self._lock:
+            prompts = dict(self.prompts)
+            if prompt_text is None:
+                prompts.pop(personality_name, None)
+            else:
+                prompts[personality_name] = prompt_text
+            self.prompts = prompts
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self._ready.is_set(),
+            "change_stream_active": self.change_stream_active,
+            "blocked_users": len(self.blocked_ids),
+            "db_prompts": len(self.prompts),
+            "reloads": self.reloads,
+            "events_applied": self.events_applied,
+            "age_s": time.monotonic() - self.loaded_at if self.loaded_at else None,
+        }
+
+
+hot_config = HotConfigCache()
+
+def get_personality_prompt(personality_name: str) -> str:
+    """Resolves a personality prompt: DB prompt first, then the local defaults."""
+    if is_db_connected():
+        try:
+            prompt_text = hot_config.get_prompt(personality_name)
+            if prompt_text:
+                return prompt_text
+        except Exception as e:
+            logger.error(f"Error resolving prompt '{personality_name}': {e}")
+    return PERSONALITIES.get(personality_name, PERSONALITIES["default"])
+
 
 # --- NEW: BOT STATUS (ON/OFF) FUNCTIONS ---
 def set_bot_status(is_on: bool):
@@ -159,122 +849,2541 @@ def set_bot_status(is_on: bool):
             {"$set": {"is_on": is_on}},
             upsert=True
         )
+        hot_config.write_bot_on(is_on)
+        hot_config.bump_version()
         logger.info(f"Bot status set to: {'ON' if is_on else 'OFF'}")
     except Exception as e:
         logger.error(f"Error setting bot status: {e}")
 
-def is_bot_on() -> bool:
-    """Checks the database to see if the bot should be on."""
+def is_bot_on() -> bool:
+    """Checks the (cached) global status to see if the bot should be on."""
+    if not is_db_connected():
+        return False # Fail safe: if DB is down, bot is off
+    try:
+        is_on = hot_config.get_bot_on()
+        if is_on is None:
+            # If no status is set, default to ON
+            set_bot_status(True)
+            return True
+        return is_on
+    except Exception as e:
+        logger.error(f"Error getting bot status: {e}")
+        return False # Fail safe
+
+
+# --- STATS COUNTERS (O(1) reads for /admin_stats and the dashboard) ---
+# Totals live in one bot_stats document and are kept current with $inc by the
+# code paths that create or delete users, blocks and chats. Daily rollups
+# (messages, active users) go to stats_daily, one document per UTC day.
+STATS_DOC_ID = "counters"
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+def bump_stats(daily: dict = None, **counters):
+    """Atomically increments total counters and/or today's rollup."""
+    try:
+        counters = {key: value for key, value in counters.items() if value}
+        if counters:
+            stats_col.update_one({"_id": STATS_DOC_ID}, {"$inc": counters}, upsert=True)
+        daily = {key: value for key, value in (daily or {}).items() if value}
+        if daily:
+            stats_daily_col.update_one({"_id": _today()}, {"$inc": daily}, upsert=True)
+    except Exception as e:
+        logger.error(f"Error updating stats counters: {e}")
+
+def reconcile_stats() -> dict:
+    """Recounts the collections and resets the counters (the offline correction job)."""
+    counters = {
+        "users": users_col.count_documents({}),
+        "blocked": blocked_col.count_documents({}),
+        "chats": chats_col.count_documents({}),
+    }
+    stats_col.update_one(
+        {"_id": STATS_DOC_ID},
+        {"$set": dict(counters, reconciled_at=datetime.now(timezone.utc))},
+        upsert=True,
+    )
+    logger.info(f"Stats counters reconciled: {counters}")
+    return counters
+
+def get_bot_stats() -> dict:
+    counters = stats_col.find_one({"_id": STATS_DOC_ID})
+    if counters is None or "users" not in counters:
+        counters = reconcile_stats()
+    today = stats_daily_col.find_one({"_id": _today()}) or {}
+    return {
+        "total_users": counters.get("users", 0),
+        "total_blocked": counters.get("blocked", 0),
+        "total_chats": counters.get("chats", 0),
+        "active_today": today.get("active_users", 0),
+        "messages_today": today.get("messages", 0),
+    }
+
+def get_daily_stats(days: int = 14) -> list:
+    """Daily messages/active users for the last `days` days, oldest first (dashboard charts)."""
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    return list(stats_daily_col.find({"_id": {"$gte": since}}).sort("_id", pymongo.ASCENDING))
+
+def reconcile_stats_if_due():
+    counters = stats_col.find_one({"_id": STATS_DOC_ID}, {"reconciled_at": 1})
+    reconciled_at = counters.get("reconciled_at") if counters else None
+    if reconciled_at is not None and reconciled_at.tzinfo is None:
+        reconciled_at = reconciled_at.replace(tzinfo=timezone.utc)
+    if reconciled_at is None or datetime.now(timezone.utc) - reconciled_at > timedelta(seconds=STATS_RECONCILE_INTERVAL):
+        reconcile_stats()
+
+async def run_stats_reconciler():
+    """Background loop: recount whenever the last reconcile is older than STATS_RECONCILE_INTERVAL."""
+    while True:
+        try:
+            if is_db_connected():
+                await run_db("reconcile_stats", reconcile_stats_if_due)
+        except Exception as e:
+            logger.error(f"Error reconciling stats: {e}")
+        await asyncio.sleep(min(STATS_RECONCILE_INTERVAL, 3600))
+
+
+# --- WRITE-BEHIND BUFFER (users upserts + chat_logs) ---
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces per-user upserts and batches chat_logs inserts off the hot path.
+
+    Updates for the same user within one flush window are merged ($set fields
+    overwrite, $inc counters add up) and written as a single unordered
+    bulk_write; audit entries go out with insert_many once the batch size or
+    the flush interval is reached. Memory is bounded: when a buffer is full,
+    producers on worker threads wait up to WRITE_BEHIND_BLOCK_TIMEOUT for the
+    flusher and then drop the entry (counted in stats); producers on an event
+    loop never wait and drop right away. close() flushes everything and is
+    registered with atexit so a gunicorn worker restart loses nothing.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._users = {}  # user_id_str -> {"$set": {...}, "$inc": {...}, "$setOnInsert": {...}}
+        self._logs = []
+        self._thread = None
+        self._closed = False
+        self.flushes = 0
+        self.users_written = 0
+        self.logs_written = 0
+        self.dropped_users = 0
+        self.dropped_logs = 0
+        self.flush_errors = 0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _wait_for_room(self, is_full) -> bool:
+        """Backpressure: wakes the flusher and waits briefly. Caller holds _cond."""
+        if not is_full():
+            return True
+        self._cond.notify_all()
+        if _on_event_loop():
+            return False  # never stall the Telegram loop; the entry is dropped and counted
+        deadline = time.monotonic() + WRITE_BEHIND_BLOCK_TIMEOUT
+        while is_full():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._closed:
+                return False
+            self._cond.wait(remaining)
+        return True
+
+    @staticmethod
+    def _merge_user(pending: dict, update: dict):
+        for op, fields in update.items():
+            target = pending.setdefault(op, {})
+            if op == "$inc":
+                for key, value in fields.items():
+                    target[key] = target.get(key, 0) + value
+            elif op == "$setOnInsert":
+                for key, value in fields.items():
+                    target.setdefault(key, value)
+            else:
+                target.update(fields)
+
+    def record_user(self, user_id_str: str, update: dict):
+        with self._cond:
+            self._ensure_started()
+            pending = self._users.get(user_id_str)
+            if pending is None:
+                if not self._wait_for_room(lambda: len(self._users) >= WRITE_BEHIND_MAX_USERS):
+                    self.dropped_users += 1
+                    return
+                pending = self._users.setdefault(user_id_str, {})
+            self._merge_user(pending, update)
+
+    def record_log(self, doc: dict):
+        with self._cond:
+            self._ensure_started()
+            if not self._wait_for_room(lambda: len(self._logs) >= WRITE_BEHIND_MAX_LOGS):
+                self.dropped_logs += 1
+                return
+            self._logs.append(doc)
+            if len(self._logs) >= WRITE_BEHIND_BATCH_SIZE:
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._logs) < WRITE_BEHIND_BATCH_SIZE:
+                    self._cond.wait(WRITE_BEHIND_FLUSH_INTERVAL)
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Writes out everything buffered so far. Safe to call from any thread."""
+        with self._cond:
+            users, self._users = self._users, {}
+            logs, self._logs = self._logs, []
+            self._cond.notify_all()
+        if not users and not logs:
+            return
+        if not is_db_connected():
+            self._requeue(users, logs)
+            return
+        try:
+            if users:
+                operations = [
+                    pymongo.UpdateOne({"_id": user_id_str}, update, upsert=True)
+                    for user_id_str, update in users.items()
+                ]
+                result = users_col.bulk_write(operations, ordered=False)
+                # Applied: from here on these updates must never be requeued.
+                applied, users = users, {}
+                self.users_written += len(operations)
+                messages = sum(update.get("$inc", {}).get("message_count", 0) for update in applied.values())
+                bump_stats(users=result.upserted_count, daily={"messages": messages})
+                self._mark_active(applied)
+            while logs:
+                batch = logs[:WRITE_BEHIND_BATCH_SIZE]
+                logs_col.insert_many(batch, ordered=False)
+                self.logs_written += len(batch)
+                logs = logs[WRITE_BEHIND_BATCH_SIZE:]
+            self.flushes += 1
+        except (pymongo.errors.ConnectionFailure, pymongo.errors.ServerSelectionTimeoutError) as e:
+            # Transient: keep the data and try again on the next flush.
+            self.flush_errors += 1
+            logger.error(f"Write-behind flush failed, will retry: {e}")
+            self._requeue(users, logs)
+        except Exception as e:
+            # Data-level errors (e.g. BulkWriteError) would fail again; do not
+            # replay partially applied $inc updates.
+            self.flush_errors += 1
+            logger.error(f"Write-behind flush failed, dropping batch: {e}")
+
+    def _mark_active(self, users: dict):
+        """
+        Daily-active detection: only users not yet marked for today match. Runs
+        after the upserts are applied and never requeues them; a failure here
+        only undercounts today's active users.
+        """
+        today = _today()
+        try:
+            activity = users_col.bulk_write([
+                pymongo.UpdateOne(
+                    {"_id": user_id_str, "last_active_day": {"$ne": today}},
+                    {"$set": {"last_active_day": today}},
+                )
+                for user_id_str in users
+            ], ordered=False)
+            bump_stats(daily={"active_users": activity.modified_count})
+        except Exception as e:
+            logger.error(f"Error marking daily active users: {e}")
+
+    def _requeue(self, users: dict, logs: list):
+        with self._cond:
+            for user_id_str, update in users.items():
+                pending = self._users.setdefault(user_id_str, {})
+                self._merge_user(pending, update)
+            if len(self._users) > WRITE_BEHIND_MAX_USERS:
+                overflow = len(self._users) - WRITE_BEHIND_MAX_USERS
+                for user_id_str in list(self._users)[:overflow]:
+                    del self._users[user_id_str]
+                self.dropped_users += overflow
+            self._logs = logs + self._logs
+            if len(self._logs) > WRITE_BEHIND_MAX_LOGS:
+                overflow = len(self._logs) - WRITE_BEHIND_MAX_LOGS
+                del self._logs[:overflow]
+                self.dropped_logs += overflow
+
+    def close(self):
+        """Stops the flusher and writes out whatever is still buffered."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending_users, pending_logs = len(self._users), len(self._logs)
+        return {
+            "pending_users": pending_users,
+            "pending_logs": pending_logs,
+            "flushes": self.flushes,
+            "users_written": self.users_written,
+            "logs_written": self.logs_written,
+            "dropped_users": self.dropped_users,
+            "dropped_logs": self.dropped_logs,
+            "flush_errors": self.flush_errors,
+        }
+
+
+write_behind = WriteBehindBuffer()
+atexit.register(write_behind.close)
+
+
+# --- USERS, BLOCKLIST, ACTIVITY LOG & ACTIVE CHATS ---
+def log_user(user: Update.effective_user):
+    """Buffers a users upsert; the write-behind flusher sends it in the next bulk_write."""
+    if not user or users_col is None:
+        return
+    try:
+        user_id_str = str(user.id)
+        if user.id < 0:
+            return
+        now = logging.Formatter().formatTime(logging.makeLogRecord({}))
+        write_behind.record_user(user_id_str, {
+            "$set": {
+                "username": user.username,
+                "first_name": user.first_name,
+                "last_seen": now,
+            },
+            "$inc": {"message_count": 1},
+            "$setOnInsert": {"first_seen": now},
+        })
+    except Exception as e:
+        logger.error(f"Error in log_user: {e}")
+
+def log_activity(user, chat_id: int, action: str = None, message_type: str = None,
+                 message_text: str = None, details: dict = None):
+    """Appends an entry to the chat_logs audit trail (batched via write-behind)."""
+    if not user or logs_col is None:
+        return
+    try:
+        write_behind.record_log({
+            "timestamp": datetime.now(timezone.utc),
+            "user_id": user.id,
+            "user_name": user.first_name,
+            "user_username": user.username,
+            "user_last_name": user.last_name,
+            "user_is_bot": user.is_bot,
+            "user_language_code": user.language_code,
+            "chat_id": chat_id,
+            "message_type": message_type,
+            "message_text": message_text,
+            "action": action,
+            "details": details or {},
+        })
+        if action and user.id > 0:
+            write_behind.record_user(str(user.id), {"$inc": {"action_count": 1}})
+    except Exception as e:
+        logger.error(f"Error in log_activity: {e}")
+
+def is_user_blocked(user_id: int) -> bool:
+    if is_admin(user_id) or not is_db_connected():
+        return False
+    try:
+        return hot_config.is_blocked(str(user_id))
+    except Exception as e:
+        logger.error(f"Error in is_user_blocked: {e}")
+        return False
+
+def block_user(user_id_to_block: int) -> str:
+    if not is_db_connected():
+        return "Database error."
+    if is_admin(user_id_to_block):
+        return "Cannot block the admin."
+    try:
+        result = blocked_col.update_one(
+            {"_id": str(user_id_to_block)}, {"$set": {"blocked": True}}, upsert=True
+        )
+        if result.upserted_id is not None:
+            bump_stats(blocked=1)
+        hot_config.write_blocked(str(user_id_to_block), True)
+        hot_config.bump_version()
+        return f"User {user_id_to_block} has been blocked."
+    except Exception as e:
+        logger.error(f"Error in block_user: {e}")
+        return "An error occurred while blocking."
+
+def unblock_user(user_id_to_unblock: int) -> str:
+    if not is_db_connected():
+        return "Database error."
+    try:
+        result = blocked_col.delete_one({"_id": str(user_id_to_unblock)})
+        hot_config.write_blocked(str(user_id_to_unblock), False)
+        hot_config.bump_version()
+        if result.deleted_count > 0:
+            bump_stats(blocked=-1)
+            return f"User {user_id_to_unblock} has been unblocked."
+        else:
+            return f"User {user_id_to_unblock} was not in the block list."
+    except Exception as e:
+        logger.error(f"Error in unblock_user: {e}")
+        return "An error occurred while unblocking."
+
+def update_active_chats(chat_id: int, action: str = "add"):
+    if not is_db_connected():
+        return
+    try:
+        if action == "add":
+            result = chats_col.update_one(
+                {"_id": chat_id}, {"$set": {"active": True}}, upsert=True
+            )
+            if result.upserted_id is not None:
+                bump_stats(chats=1)
+        elif action == "remove":
+            if chats_col.delete_one({"_id": chat_id}).deleted_count:
+                bump_stats(chats=-1)
+    except Exception as e:
+        logger.error(f"Error in update_active_chats: {e}")
+
+CHAT_HISTORY_LIMIT = 20
+# Turns left out of the prompt are folded into the rolling summary in batches
+# of this many, so a long chat costs one summary call every few messages
+# instead of one per message.
+SUMMARY_BATCH_TURNS = 8
+# Turns older than this are never put in the prompt; the gap up to
+# CHAT_HISTORY_LIMIT is where they wait for the next summary batch before
+# $slice drops them from the document.
+CONTEXT_MAX_TURNS = CHAT_HISTORY_LIMIT - SUMMARY_BATCH_TURNS
+
+class ChatHistoryCache:
+    """
+    Small per-worker LRU of recent chat histories, keyed by chat_id.
+
+    Each entry carries the document's `version` (bumped on every write), so an
+    append only updates the cached copy when nobody else wrote in between;
+    otherwise the entry is dropped and the next read goes back to MongoDB.
+    Entries also expire after HISTORY_CACHE_TTL to pick up other workers' turns.
+    Alongside the history, `meta` holds the rolling summary fields.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # chat_id -> (version, history, meta, cached_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int, allow_stale: bool = False):
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None or (not allow_stale and time.monotonic() - entry[3] > HISTORY_CACHE_TTL):
+                if not allow_stale:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            if not allow_stale:
+                self.hits += 1
+            return entry[0], entry[1], entry[2]
+
+    def put(self, chat_id: int, version: int, history: list, meta: dict):
+        with self._lock:
+            self._entries[chat_id] = (version, history, meta, time.monotonic())
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def update_meta(self, chat_id: int, **fields):
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None:
+                entry[2].update(fields)
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+history_cache = ChatHistoryCache(HISTORY_CACHE_SIZE)
+
+HISTORY_PROJECTION = {"history": 1, "version": 1, "turn_count": 1, "summary": 1, "summary_through": 1}
+
+def _history_meta(chat_doc) -> dict:
+    history = chat_doc.get("history", []) if chat_doc else []
+    return {
+        # Absolute number of turns ever appended; older documents predate it.
+        "turn_count": chat_doc.get("turn_count", len(history)) if chat_doc else 0,
+        "summary": chat_doc.get("summary", "") if chat_doc else "",
+        "summary_through": chat_doc.get("summary_through", 0) if chat_doc else 0,
+    }
+
+def get_chat_state(chat_id: int):
+    """Returns (history, meta) for a chat, from the LRU when possible."""
+    cached = history_cache.get(chat_id)
+    if cached is not None:
+        return list(cached[1]), dict(cached[2])
+    if not is_db_connected():
+        return [], _history_meta(None)
+    try:
+        chat_doc = history_col.find_one({"_id": chat_id}, HISTORY_PROJECTION)
+        history = chat_doc.get("history", []) if chat_doc else []
+        version = chat_doc.get("version", 0) if chat_doc else 0
+        meta = _history_meta(chat_doc)
+        history_cache.put(chat_id, version, history, meta)
+        return list(history), dict(meta)
+    except Exception as e:
+        logger.error(f"Error getting chat history: {e}")
+        return [], _history_meta(None)
+
+def get_chat_history(chat_id: int) -> list:
+    return get_chat_state(chat_id)[0]
+
+def append_chat_history(chat_id: int, new_turns: list):
+    """Appends only the new turns with $push/$each/$slice, keeping the last CHAT_HISTORY_LIMIT."""
+    if not new_turns or not is_db_connected():
+        return
+    try:
+        result = history_col.find_one_and_update(
+            {"_id": chat_id},
+            {
+                "$push": {"history": {"$each": new_turns, "$slice": -CHAT_HISTORY_LIMIT}},
+                "$inc": {"version": 1, "turn_count": len(new_turns)},
+            },
+            projection={"version": 1, "turn_count": 1},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        new_version = result.get("version", 0) if result else 0
+        cached = history_cache.get(chat_id, allow_stale=True)
+        if cached is not None and cached[0] == new_version - 1:
+            meta = dict(cached[2], turn_count=result.get("turn_count", 0))
+            history_cache.put(chat_id, new_version, (cached[1] + new_turns)[-CHAT_HISTORY_LIMIT:], meta)
+        else:
+            # Another worker wrote in between; re-read on next use.
+            history_cache.invalidate(chat_id)
+    except Exception as e:
+        logger.error(f"Error appending chat history: {e}")
+
+def _tail_overlap(previous: list, history: list) -> int:
+    """Length of the longest tail of `previous` that `history` starts with."""
+    for size in range(min(len(previous), len(history)), 0, -1):
+        if previous[-size:] == history[:size]:
+            return size
+    return 0
+
+def save_chat_history(chat_id: int, history: list):
+    """
+    Persists `history` for the chat. When it extends what get_chat_history()
+    returned, only the new turns are sent (see append_chat_history); anything
+    else falls back to rewriting the whole array.
+    """
+    if not is_db_connected():
+        return
+    cached = history_cache.get(chat_id, allow_stale=True)
+    if cached is not None:
+        cached_history = cached[1]
+        if len(history) >= len(cached_history) and history[:len(cached_history)] == cached_history:
+            append_chat_history(chat_id, history[len(cached_history):])
+            return
+    try:
+        if cached is not None:
+            previous, meta = cached[1], cached[2]
+        else:
+            previous, meta = get_chat_state(chat_id)
+        if len(history) > CHAT_HISTORY_LIMIT:
+            history = history[-CHAT_HISTORY_LIMIT:]
+        # Keep turn_count absolute: turns that continue the stored tail are old,
+        # everything after them is new (a caller trimming before saving lands here).
+        turn_count = meta.get("turn_count", len(previous)) + len(history) - _tail_overlap(previous, history)
+        result = history_col.find_one_and_update(
+            {"_id": chat_id},
+            {"$set": {"history": history, "turn_count": turn_count}, "$inc": {"version": 1}},
+            projection=HISTORY_PROJECTION,
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        history_cache.put(chat_id, result.get("version", 0) if result else 0, list(history), _history_meta(result))
+    except Exception as e:
+        logger.error(f"Error saving chat history: {e}")
+
+def save_rolling_summary(chat_id: int, summary: str, summary_through: int):
+    """Stores the rolling summary, never moving summary_through backwards."""
+    if not is_db_connected():
+        return
+    try:
+        result = history_col.update_one(
+            {"_id": chat_id, "$or": [
+                {"summary_through": {"$exists": False}},
+                {"summary_through": {"$lt": summary_through}},
+            ]},
+            {"$set": {"summary": summary, "summary_through": summary_through}},
+        )
+        if result.matched_count:
+            history_cache.update_meta(chat_id, summary=summary, summary_through=summary_through)
+    except Exception as e:
+        logger.error(f"Error saving rolling summary: {e}")
+
+
+def save_prompt(personality_name: str, prompt_text: str):
+    """Upserts a personality prompt and writes it through to the hot config cache."""
+    prompts_col.update_one(
+        {"_id": personality_name},
+        {"$set": {"prompt": prompt_text}},
+        upsert=True
+    )
+    hot_config.write_prompt(personality_name, prompt_text)
+    hot_config.bump_version()
+
+def delete_prompt(personality_name: str) -> bool:
+    """Deletes a DB personality prompt; returns True if one existed."""
+    result = prompts_col.delete_one({"_id": personality_name})
+    hot_config.write_prompt(personality_name, None)
+    hot_config.bump_version()
+    return result.deleted_count > 0
+
+# --- CHAT LOG STORE (indexes, keyset pages, retention) ---
+# Fields shown by /admin_logs; everything else stays on the server.
+LOG_DISPLAY_PROJECTION = {
+    "timestamp": 1, "user_id": 1, "user_name": 1, "user_username": 1,
+    "action": 1, "message_type": 1, "message_text": 1,
+}
+
+def ensure_log_indexes():
+    """
+    Creates the chat_logs indexes. Pages are keyed on _id (ObjectIds grow with
+    insertion time), so the global listing uses the built-in _id index and
+    per-user listings use user_id + _id. Retention is a TTL index on timestamp.
+    """
+    logs_col.create_index([("user_id", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], name="user_id_recent")
+    logs_col.create_index([("action", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], name="action_recent")
+    if LOG_RETENTION_DAYS > 0:
+        expire_after = LOG_RETENTION_DAYS * 86400
+        try:
+            logs_col.create_index("timestamp", name="timestamp_ttl", expireAfterSeconds=expire_after)
+        except pymongo.errors.OperationFailure:
+            # The TTL index exists with a different retention; change it in place.
+            db.command("collMod", logs_col.name, index={"name": "timestamp_ttl", "expireAfterSeconds": expire_after})
+    else:
+        try:
+            logs_col.drop_index("timestamp_ttl")
+        except pymongo.errors.OperationFailure:
+            pass
+
+def fetch_logs_page(user_id: int = None, before_id: str = None, limit: int = LOG_PAGE_SIZE):
+    """Returns (entries, has_more) for one page, newest first, strictly older than before_id."""
+    query = {}
+    if user_id is not None:
+        query["user_id"] = user_id
+    if before_id:
+        query["_id"] = {"$lt": ObjectId(before_id)}
+    entries = list(
+        logs_col.find(query, LOG_DISPLAY_PROJECTION).sort("_id", pymongo.DESCENDING).limit(limit + 1)
+    )
+    return entries[:limit], len(entries) > limit
+
+
+# --- BROADCAST JOB STORE ---
+def create_broadcast_job(text: str, photo: str, caption: str, requested_by: int) -> str:
+    now = datetime.now(timezone.utc)
+    result = jobs_col.insert_one({
+        "status": "running",
+        "text": text,
+        "photo": photo,
+        "caption": caption,
+        "requested_by": requested_by,
+        "owner": WORKER_ID,
+        "lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS),
+        "total_estimate": users_col.estimated_document_count(),
+        "last_user_id": None,
+        "sent": 0,
+        "failed": 0,
+        "removed": 0,
+        "created_at": now,
+        "updated_at": now,
+    })
+    return str(result.inserted_id)
+
+def fetch_broadcast_batch(after_user_id, limit: int) -> list:
+    """Next page of user IDs in _id order (keyset pagination, resumable)."""
+    query = {} if after_user_id is None else {"_id": {"$gt": after_user_id}}
+    cursor = users_col.find(query, {"_id": 1}).sort("_id", pymongo.ASCENDING).limit(limit)
+    return [doc["_id"] for doc in cursor]
+
+def checkpoint_broadcast_job(job_id: str, last_user_id, counts: dict, status: str = None) -> bool:
+    """
+    Records progress and renews this worker's lease. Returns False when the
+    job is no longer owned by this worker (its lease expired and another
+    worker claimed it), in which case nothing is written.
+    """
+    now = datetime.now(timezone.utc)
+    update = {
+        "$set": {
+            "last_user_id": last_user_id,
+            "updated_at": now,
+            "lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS),
+        },
+        "$inc": counts,
+    }
+    if status:
+        update["$set"]["status"] = status
+    result = jobs_col.update_one({"_id": ObjectId(job_id), "owner": WORKER_ID}, update)
+    return result.matched_count == 1
+
+def renew_broadcast_lease(job_id: str) -> bool:
+    """Extends this worker's lease on a job; False if another worker owns it now."""
+    now = datetime.now(timezone.utc)
+    result = jobs_col.update_one(
+        {"_id": ObjectId(job_id), "owner": WORKER_ID, "status": "running"},
+        {"$set": {"lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS)}},
+    )
+    return result.matched_count == 1
+
+def get_broadcast_job(job_id: str):
+    return jobs_col.find_one({"_id": ObjectId(job_id)})
+
+def get_broadcast_jobs(limit: int = 5) -> list:
+    return list(jobs_col.find({}, {"text": 0}).sort("created_at", pymongo.DESCENDING).limit(limit))
+
+def claim_broadcast_job():
+    """
+    Atomically takes over one running job whose lease has expired (its worker
+    died or stalled), or returns None. Jobs from before leases existed have
+    no lease_until and are claimable too.
+    """
+    now = datetime.now(timezone.utc)
+    return jobs_col.find_one_and_update(
+        {"status": "running", "$or": [{"lease_until": {"$lt": now}}, {"lease_until": {"$exists": False}}]},
+        {"$set": {"owner": WORKER_ID, "lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS)}},
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+
+def get_media_file_id(key: str):
+    doc = media_col.find_one({"_id": key}, {"file_id": 1})
+    return doc.get("file_id") if doc else None
+
+def save_media_file_id(key: str, kind: str, file_id: str):
+    media_col.update_one(
+        {"_id": key},
+        {"$set": {"kind": kind, "file_id": file_id, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+def remove_user(user_id_str: str):
+    """Forgets a user who blocked the bot, so broadcasts stop targeting them."""
+    if users_col.delete_one({"_id": user_id_str}).deleted_count:
+        bump_stats(users=-1)
+
+
+# --- FORCE-JOIN MEMBERSHIP STORE ---
+def ensure_membership_indexes():
+    """Expired verifications are removed by a TTL index on expires_at."""
+    membership_col.create_index("expires_at", name="expires_at_ttl", expireAfterSeconds=0)
+
+def get_membership(user_id: int):
+    """Returns (is_member, expires_at) for an unexpired verification, or None."""
+    now = datetime.now(timezone.utc)
+    doc = membership_col.find_one({"_id": user_id, "expires_at": {"$gt": now}})
+    if not doc:
+        return None
+    expires_at = doc["expires_at"]
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return doc["is_member"], expires_at
+
+def save_membership(user_id: int, is_member: bool, expires_at):
+    membership_col.update_one(
+        {"_id": user_id},
+        {"$set": {"is_member": is_member, "expires_at": expires_at, "checked_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+def delete_membership(user_id: int):
+    membership_col.delete_one({"_id": user_id})
+
+
+# --- ASYNC DATA-ACCESS LAYER ---
+# pymongo is synchronous, so every DB call made from an async handler runs on a
+# dedicated, bounded thread pool instead of blocking the Telegram event loop.
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="mongo")
+db_op_latency = {}  # op name -> LatencyHistogram (time spent inside pymongo)
+db_queue_latency = LatencyHistogram()  # time spent waiting for a free executor thread
+handler_latency = {}  # handler name -> LatencyHistogram (end-to-end)
+
+def _histogram(registry: dict, name: str) -> LatencyHistogram:
+    histogram = registry.get(name)
+    if histogram is None:
+        histogram = registry.setdefault(name, LatencyHistogram())
+    return histogram
+
+async def run_db(op_name: str, fn, *args, **kwargs):
+    """Runs a blocking DB function on the DB executor and records its latency."""
+    submitted = time.perf_counter()
+
+    def timed_call():
+        started = time.perf_counter()
+        db_queue_latency.observe(started - submitted)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _histogram(db_op_latency, op_name).observe(time.perf_counter() - started)
+
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(db_executor, timed_call)
+    finally:
+        record_span(f"db:{op_name}", time.perf_counter() - submitted)
+
+
+class AsyncRepository:
+    """Awaitable versions of the DB helpers, for use inside Telegram handlers."""
+
+    # These two only append to the write-behind buffer, so they run inline on
+    # the loop (drop on full, never wait) instead of holding a db_executor thread.
+    async def log_user(self, user):
+        log_user(user)
+
+    async def log_activity(self, user, chat_id: int, action: str = None, message_type: str = None,
+                           message_text: str = None, details: dict = None):
+        log_activity(user, chat_id, action, message_type, message_text, details)
+
+    async def is_user_blocked(self, user_id: int) -> bool:
+        return await run_db("is_user_blocked", is_user_blocked, user_id)
+
+    async def block_user(self, user_id: int) -> str:
+        return await run_db("block_user", block_user, user_id)
+
+    async def unblock_user(self, user_id: int) -> str:
+        return await run_db("unblock_user", unblock_user, user_id)
+
+    async def is_bot_on(self) -> bool:
+        return await run_db("is_bot_on", is_bot_on)
+
+    async def set_bot_status(self, is_on: bool):
+        return await run_db("set_bot_status", set_bot_status, is_on)
+
+    async def update_active_chats(self, chat_id: int, action: str = "add"):
+        return await run_db("update_active_chats", update_active_chats, chat_id, action)
+
+    async def get_chat_history(self, chat_id: int) -> list:
+        return await run_db("get_chat_history", get_chat_history, chat_id)
+
+    async def save_chat_history(self, chat_id: int, history: list):
+        return await run_db("save_chat_history", save_chat_history, chat_id, history)
+
+    async def append_chat_history(self, chat_id: int, new_turns: list):
+        return await run_db("append_chat_history", append_chat_history, chat_id, new_turns)
+
+    async def get_chat_state(self, chat_id: int):
+        return await run_db("get_chat_state", get_chat_state, chat_id)
+
+    async def save_rolling_summary(self, chat_id: int, summary: str, summary_through: int):
+        return await run_db("save_rolling_summary", save_rolling_summary, chat_id, summary, summary_through)
+
+    async def save_prompt(self, personality_name: str, prompt_text: str):
+        return await run_db("save_prompt", save_prompt, personality_name, prompt_text)
+
+    async def delete_prompt(self, personality_name: str) -> bool:
+        return await run_db("delete_prompt", delete_prompt, personality_name)
+
+    async def get_bot_stats(self) -> dict:
+        return await run_db("get_bot_stats", get_bot_stats)
+
+    async def get_daily_stats(self, days: int = 14) -> list:
+        return await run_db("get_daily_stats", get_daily_stats, days)
+
+    async def create_broadcast_job(self, text: str, photo: str, caption: str, requested_by: int) -> str:
+        return await run_db("create_broadcast_job", create_broadcast_job, text, photo, caption, requested_by)
+
+    async def fetch_broadcast_batch(self, after_user_id, limit: int) -> list:
+        return await run_db("fetch_broadcast_batch", fetch_broadcast_batch, after_user_id, limit)
+
+    async def checkpoint_broadcast_job(self, job_id: str, last_user_id, counts: dict, status: str = None) -> bool:
+        return await run_db("checkpoint_broadcast_job", checkpoint_broadcast_job, job_id, last_user_id, counts, status)
+
+    async def renew_broadcast_lease(self, job_id: str) -> bool:
+        return await run_db("renew_broadcast_lease", renew_broadcast_lease, job_id)
+
+    async def get_broadcast_job(self, job_id: str):
+        return await run_db("get_broadcast_job", get_broadcast_job, job_id)
+
+    async def get_broadcast_jobs(self, limit: int = 5) -> list:
+        return await run_db("get_broadcast_jobs", get_broadcast_jobs, limit)
+
+    async def claim_broadcast_job(self):
+        return await run_db("claim_broadcast_job", claim_broadcast_job)
+
+    async def fetch_logs_page(self, user_id: int = None, before_id: str = None, limit: int = LOG_PAGE_SIZE):
+        return await run_db("fetch_logs_page", fetch_logs_page, user_id, before_id, limit)
+
+    async def get_media_file_id(self, key: str):
+        return await run_db("get_media_file_id", get_media_file_id, key)
+
+    async def save_media_file_id(self, key: str, kind: str, file_id: str):
+        return await run_db("save_media_file_id", save_media_file_id, key, kind, file_id)
+
+    async def get_membership(self, user_id: int):
+        return await run_db("get_membership", get_membership, user_id)
+
+    async def save_membership(self, user_id: int, is_member: bool, expires_at):
+        return await run_db("save_membership", save_membership, user_id, is_member, expires_at)
+
+    async def delete_membership(self, user_id: int):
+        return await run_db("delete_membership", delete_membership, user_id)
+
+    async def remove_user(self, user_id_str: str):
+        return await run_db("remove_user", remove_user, user_id_str)
+
+
+repo = AsyncRepository()
+
+def track_latency(handler_name: str):
+    """
+    Decorator recording a handler's end-to-end latency in handler_latency.
+    It also collects the request's trace spans, logged for a TRACE_SAMPLE_RATE
+    sample and for every request slower than TRACE_SLOW_MS, and runs the
+    one-shot profiler when /admin_profile has armed it.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            spans = []
+            token = _current_trace.set(spans)
+            profile = request_profiler.claim(handler_name)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                _current_trace.reset(token)
+                _histogram(handler_latency, handler_name).observe(elapsed)
+                if profile is not None:
+                    context = args[1] if len(args) > 1 else None
+                    request_profiler.finish(profile, handler_name, elapsed, getattr(context, "bot", None))
+                if elapsed * 1000 >= TRACE_SLOW_MS or random.random() < TRACE_SAMPLE_RATE:
+                    log_trace(handler_name, elapsed, spans)
+        return wrapper
+    return decorator
+
+
+class RequestProfiler:
+    """
+    One-shot cProfile capture armed by /admin_profile. The next request to the
+    chosen handler (or any tracked handler) is profiled and the report is sent
+    to the admin. cProfile sees the whole event-loop thread, so other updates
+    handled at the same time show up in the report too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.armed_for = None  # handler name, "*" for any, or None
+        self.active = False
+        self.last_report = None
+
+    def arm(self, handler_name: str = "*"):
+        with self._lock:
+            self.armed_for = handler_name
+
+    def claim(self, handler_name: str):
+        with self._lock:
+            if self.active or self.armed_for not in ("*", handler_name):
+                return None
+            self.armed_for = None
+            self.active = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:  # another profiler is already running in this process
+            logger.error(f"Could not start profiler: {e}")
+            self.active = False
+            return None
+        return profile
+
+    def finish(self, profile, handler_name: str, elapsed: float, bot=None):
+        profile.disable()
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        self.last_report = f"Profile of {handler_name} ({elapsed * 1000:.0f}ms)\n\n{stream.getvalue()}"
+        self.active = False
+        logger.info(f"Captured profile of {handler_name} ({elapsed * 1000:.0f}ms).")
+        if bot is not None:
+            _spawn_background(self._send_report(bot, handler_name))
+
+    async def _send_report(self, bot, handler_name: str):
+        try:
+            await bot.send_document(
+                chat_id=ADMIN_USER_ID,
+                document=io.BytesIO(self.last_report.encode()),
+                filename=f"profile-{handler_name}.txt",
+            )
+        except Exception as e:
+            logger.error(f"Error sending profile report: {e}")
+
+
+request_profiler = RequestProfiler()
+
+def get_latency_stats() -> dict:
+    """p50/p95/p99 per DB op and per handler, for the dashboard."""
+    return {
+        "db_ops": {name: h.snapshot() for name, h in db_op_latency.items()},
+        "db_queue": db_queue_latency.snapshot(),
+        "handlers": {name: h.snapshot() for name, h in handler_latency.items()},
+    }
+
+
+# --- GEMINI API CLIENT (async) ---
+class GeminiError(Exception):
+    """Raised when a Gemini call fails. The message never contains the API key."""
+
+
+class GeminiClient:
+    """
+    Non-blocking Gemini client shared by the chat, vision, TTS and image paths.
+
+    One pooled httpx.AsyncClient (keep-alive) is kept per event loop, every
+    endpoint has its own timeout and concurrency semaphore, and 429/5xx answers
+    are retried with jittered exponential backoff (honouring Retry-After).
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, endpoints: dict):
+        self.endpoints = endpoints
+        self._loop = None
+        self._session = None
+        self._semaphores = {}
+        self.calls = {kind: 0 for kind in endpoints}
+        self.retries = {kind: 0 for kind in endpoints}
+        self.errors = {kind: 0 for kind in endpoints}
+        self.tokens = {}  # model -> {"prompt": n, "output": n, "total": n}
+
+    def _record_call(self, kind: str, model: str, started: float, usage: dict = None):
+        elapsed = time.perf_counter() - started
+        _histogram(gemini_latency, model).observe(elapsed)
+        record_span(f"gemini:{kind}", elapsed)
+        if usage:
+            totals = self.tokens.setdefault(model, {"prompt": 0, "output": 0, "total": 0})
+            totals["prompt"] += usage.get("promptTokenCount", 0)
+            totals["output"] += usage.get("candidatesTokenCount", 0)
+            totals["total"] += usage.get("totalTokenCount", 0)
+
+    def _ensure_session(self) -> httpx.AsyncClient:
+        # httpx clients and asyncio semaphores are bound to the loop they were
+        # first used on, so rebuild them if we are running on a new loop.
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._loop is not loop:
+            self._loop = loop
+            self._session = httpx.AsyncClient(
+                base_url=GEMINI_API_BASE,
+                headers={"x-goog-api-key": GEMINI_API_KEY or ""},
+                limits=httpx.Limits(
+                    max_connections=GEMINI_MAX_CONNECTIONS,
+                    max_keepalive_connections=GEMINI_MAX_CONNECTIONS,
+                    keepalive_expiry=60,
+                ),
+            )
+            self._semaphores = {
+                kind: asyncio.Semaphore(limit) for kind, (_, _, limit) in self.endpoints.items()
+            }
+        return self._session
+
+    @staticmethod
+    def _backoff_delay(attempt: int, retry_after=None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), 30.0)
+            except ValueError:
+                pass
+        # Full jitter: uniform(0, base * 2^attempt), capped.
+        return random.uniform(0, min(20.0, 1.0 * (2 ** attempt)))
+
+    async def generate(self, kind: str, payload: dict) -> dict:
+        """POSTs a generateContent request for the given endpoint kind and returns the JSON."""
+        model, timeout, _ = self.endpoints[kind]
+        http = self._ensure_session()
+        url = f"/models/{model}:generateContent"
+        self.calls[kind] += 1
+        started = time.perf_counter()
+        async with self._semaphores[kind]:
+            for attempt in range(GEMINI_MAX_RETRIES + 1):
+                retry_after = None
+                try:
+                    response = await http.post(url, json=payload, timeout=timeout)
+                    if response.status_code == 200:
+                        result = response.json()
+                        self._record_call(kind, model, started, result.get("usageMetadata"))
+                        return result
+                    if response.status_code not in self.RETRY_STATUSES:
+                        self.errors[kind] += 1
+                        raise GeminiError(f"Gemini {kind} call failed with HTTP {response.status_code}: {response.text[:300]}")
+                    retry_after = response.headers.get("retry-after")
+                    last_error = f"HTTP {response.status_code}"
+                except httpx.TransportError as e:
+                    last_error = type(e).__name__
+                if attempt < GEMINI_MAX_RETRIES:
+                    self.retries[kind] += 1
+                    delay = self._backoff_delay(attempt, retry_after)
+                    logger.warning(f"Gemini {kind} call got {last_error}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+        self.errors[kind] += 1
+        raise GeminiError(f"Gemini {kind} call failed after {GEMINI_MAX_RETRIES + 1} attempts ({last_error}).")
+
+    async def stream(self, kind: str, payload: dict):
+        """
+        Async generator over streamGenerateContent (SSE) yielding text chunks.
+        Failures before the first chunk are retried like generate(); a stream
+        that breaks midway raises GeminiError.
+        """
+        model, timeout, _ = self.endpoints[kind]
+        http = self._ensure_session()
+        url = f"/models/{model}:streamGenerateContent"
+        self.calls[kind] += 1
+        started = time.perf_counter()
+        first_chunk = True
+        usage = None
+        async with self._semaphores[kind]:
+            for attempt in range(GEMINI_MAX_RETRIES + 1):
+                retry_after = None
+                try:
+                    async with http.stream("POST", url, params={"alt": "sse"}, json=payload, timeout=timeout) as response:
+                        if response.status_code == 200:
+                            async for line in response.aiter_lines():
+                                if not line.startswith("data:"):
+                                    continue
+                                chunk = json.loads(line[5:])
+                                usage = chunk.get("usageMetadata") or usage  # running totals; the last one wins
+                                text = _chunk_text(chunk)
+                                if not text:
+                                    continue
+                                if first_chunk:
+                                    gemini_ttft.observe(time.perf_counter() - started)
+                                    first_chunk = False
+                                yield text
+                            self._record_call(kind, model, started, usage)
+                            return
+                        body = (await response.aread()).decode(errors="replace")
+                        if response.status_code not in self.RETRY_STATUSES:
+                            self.errors[kind] += 1
+                            raise GeminiError(f"Gemini {kind} stream failed with HTTP {response.status_code}: {body[:300]}")
+                        retry_after = response.headers.get("retry-after")
+                        last_error = f"HTTP {response.status_code}"
+                except httpx.TransportError as e:
+                    if not first_chunk:
+                        self.errors[kind] += 1
+                        raise GeminiError(f"Gemini {kind} stream interrupted ({type(e).__name__}).")
+                    last_error = type(e).__name__
+                if attempt < GEMINI_MAX_RETRIES:
+                    self.retries[kind] += 1
+                    delay = self._backoff_delay(attempt, retry_after)
+                    logger.warning(f"Gemini {kind} stream got {last_error}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+        self.errors[kind] += 1
+        raise GeminiError(f"Gemini {kind} stream failed after {GEMINI_MAX_RETRIES + 1} attempts ({last_error}).")
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "retries": dict(self.retries),
+            "errors": dict(self.errors),
+            "tokens": {model: dict(totals) for model, totals in self.tokens.items()},
+        }
+
+
+gemini_client = GeminiClient(GEMINI_ENDPOINTS)
+gemini_ttft = LatencyHistogram()  # time to first streamed token
+gemini_latency = {}  # model -> LatencyHistogram (whole call, retries included)
+
+def _response_parts(result: dict) -> list:
+    try:
+        return result["candidates"][0]["content"].get("parts", [])
+    except (KeyError, IndexError):
+        raise GeminiError(f"Gemini returned no content (finish reason: {result.get('promptFeedback', {}).get('blockReason', 'unknown')}).")
+
+def _response_text(result: dict) -> str:
+    return "".join(part.get("text", "") for part in _response_parts(result)).strip()
+
+def _chunk_text(chunk: dict) -> str:
+    """Text of one streamed chunk; trailing chunks may carry only metadata."""
+    candidates = chunk.get("candidates") or [{}]
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+def _response_inline_data(result: dict) -> bytes:
+    for part in _response_parts(result):
+        inline = part.get("inlineData") or part.get("inline_data")
+        if inline and inline.get("data"):
+            return base64.b64decode(inline["data"])
+    raise GeminiError("Gemini response did not contain any media data.")
+
+async def gemini_chat(contents: list, system_prompt: str = None, kind: str = "text") -> str:
+    """Runs a chat turn (kind="vision" when the contents carry images) and returns the reply text."""
+    payload = {"contents": contents}
+    if system_prompt:
+        payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+    return _response_text(await gemini_client.generate(kind, payload))
+
+def gemini_chat_stream(contents: list, system_prompt: str = None, kind: str = "text"):
+    """Streaming variant of gemini_chat(); returns an async iterator of text chunks."""
+    payload = {"contents": contents}
+    if system_prompt:
+        payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+    return gemini_client.stream(kind, payload)
+
+async def gemini_tts(text: str, voice: str = "kore") -> bytes:
+    """Synthesizes speech and returns raw 16-bit mono PCM at 24 kHz."""
+    payload = {
+        "contents": [{"parts": [{"text": text}]}],
+        "generationConfig": {
+            "responseModalities": ["AUDIO"],
+            "speechConfig": {"voiceConfig": {"prebuiltVoiceConfig": {"voiceName": voice.capitalize()}}},
+        },
+    }
+    return _response_inline_data(await gemini_client.generate("tts", payload))
+
+async def gemini_generate_image(prompt: str) -> bytes:
+    """Generates an image for the prompt and returns the encoded image bytes."""
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": {"responseModalities": ["TEXT", "IMAGE"]},
+    }
+    return _response_inline_data(await gemini_client.generate("image", payload))
+
+def pcm_to_wav(pcm: bytes, sample_rate: int = 24000) -> io.BytesIO:
+    """Wraps raw 16-bit mono PCM in a WAV container for upload."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    buffer.seek(0)
+    buffer.name = "ananya_voice.wav"
+    return buffer
+
+
+# --- CONTEXT BUILDER (token budget + rolling summary) ---
+SUMMARY_INSTRUCTION = (
+    "You maintain a running memory of a chat between a user and Ananya. "
+    "Merge the existing summary with the new messages into one compact summary "
+    "(under 150 words). Keep names, facts about the user, preferences and open "
+    "topics; drop small talk. Reply with the summary only."
+)
+
+def estimate_turn_tokens(turn: dict) -> int:
+    """Cheap token estimate for one Gemini `contents` entry (no API call)."""
+    tokens = 4  # role and formatting overhead
+    for part in turn.get("parts", []):
+        if "text" in part:
+            tokens += len(part["text"]) // CHARS_PER_TOKEN + 1
+        elif "inline_data" in part or "inlineData" in part:
+            tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+def _turn_as_text(turn: dict) -> str:
+    pieces = []
+    for part in turn.get("parts", []):
+        if "text" in part:
+            pieces.append(part["text"])
+        elif "inline_data" in part or "inlineData" in part:
+            pieces.append("[image]")
+    speaker = "Ananya" if turn.get("role") == "model" else "User"
+    return f"{speaker}: {' '.join(pieces)}"
+
+def build_context(history: list, meta: dict, new_turns: list, budget: int = CONTEXT_TOKEN_BUDGET):
+    """
+    Picks the newest history turns that fit in `budget` tokens alongside the
+    new turns and the rolling summary.
+
+    Returns (contents, summary, evicted) where `evicted` is the list of
+    (absolute_index, turn) pairs left out of the prompt that the stored
+    summary does not cover yet.
+    """
+    summary = meta.get("summary", "")
+    remaining = budget - sum(estimate_turn_tokens(turn) for turn in new_turns)
+    if summary:
+        remaining -= len(summary) // CHARS_PER_TOKEN + 1
+
+    start = len(history)
+    floor = max(len(history) - CONTEXT_MAX_TURNS, 0)
+    while start > floor:
+        cost = estimate_turn_tokens(history[start - 1])
+        if cost > remaining:
+            break
+        remaining -= cost
+        start -= 1
+    # Gemini expects the conversation to open with a user turn.
+    while start < len(history) and history[start].get("role") == "model":
+        start += 1
+
+    first_index = max(meta.get("turn_count", len(history)) - len(history), 0)
+    summary_through = meta.get("summary_through", 0)
+    evicted = [
+        (first_index + i, turn)
+        for i, turn in enumerate(history[:start])
+        if first_index + i >= summary_through
+    ]
+    return history[start:] + new_turns, summary, evicted
+
+def summary_due(history: list, meta: dict, evicted: list, appended: int) -> bool:
+    """
+    True once SUMMARY_BATCH_TURNS turns are waiting to be summarized, or when
+    the next save (`appended` new turns) would $slice the oldest of them away.
+    """
+    if not evicted:
+        return False
+    if len(evicted) >= SUMMARY_BATCH_TURNS:
+        return True
+    first_index = max(meta.get("turn_count", len(history)) - len(history), 0)
+    dropped_next = len(history) + appended - CHAT_HISTORY_LIMIT
+    return evicted[0][0] - first_index < dropped_next
+
+def build_system_prompt(personality_prompt: str, summary: str) -> str:
+    if not summary:
+        return personality_prompt
+    return f"{personality_prompt}\n\nWhat you remember from earlier in this conversation:\n{summary}"
+
+_summaries_in_flight = set()
+_background_tasks = set()
+
+def _spawn_background(coro):
+    """create_task that keeps a strong reference until the task finishes."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _refresh_rolling_summary(chat_id: int, previous_summary: str, evicted: list):
+    try:
+        transcript = "\n".join(_turn_as_text(turn) for _, turn in evicted)
+        request_text = f"Existing summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}"
+        summary = await gemini_chat(
+            [{"role": "user", "parts": [{"text": request_text}]}],
+            system_prompt=SUMMARY_INSTRUCTION,
+        )
+        if summary:
+            await repo.save_rolling_summary(chat_id, summary, evicted[-1][0] + 1)
+    except Exception as e:
+        logger.error(f"Error refreshing rolling summary for chat {chat_id}: {e}")
+    finally:
+        _summaries_in_flight.discard(chat_id)
+
+async def prepare_chat_context(chat_id: int, new_turns: list, personality_prompt: str):
+    """
+    Loads the chat's history and returns (contents, system_prompt) for Gemini,
+    trimmed to CONTEXT_TOKEN_BUDGET. Turns that fall out of the prompt are
+    folded into the rolling summary in the background, a batch at a time.
+    """
+    history, meta = await repo.get_chat_state(chat_id)
+    contents, summary, evicted = build_context(history, meta, new_turns)
+    # The turns saved after this request: the new ones plus the model's reply.
+    if summary_due(history, meta, evicted, len(new_turns) + 1) and chat_id not in _summaries_in_flight:
+        _summaries_in_flight.add(chat_id)
+        _spawn_background(_refresh_rolling_summary(chat_id, summary, evicted))
+    return contents, build_system_prompt(personality_prompt, summary)
+
+
+# --- MEDIA RESPONSE CACHE (/say audio, /send_image portraits) ---
+def normalize_prompt_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text or "")).strip()
+
+def media_cache_key(endpoint: str, model: str, voice: str, text: str, variant: str = "") -> str:
+    """Content address for a deterministic generation."""
+    material = json.dumps([endpoint, model, voice or "", normalize_prompt_text(text), variant])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class DiskLRUCache:
+    """Raw media bytes on local disk, evicting least recently used files past max_bytes."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.total_bytes = None  # computed lazily on first write
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mtime doubles as the LRU clock
+            self.hits += 1
+            return data
+        except OSError:
+            self.misses += 1
+            return None
+
+    def put(self, key: str, data: bytes):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            with self._lock:
+                if self.total_bytes is None:
+                    self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+                else:
+                    self.total_bytes += len(data)
+                if self.total_bytes > self.max_bytes:
+                    self._evict()
+        except OSError as e:
+            logger.error(f"Error writing media cache entry: {e}")
+
+    def _evict(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except OSError:
+                pass
+        self.total_bytes = total
+
+
+class MediaCache:
+    """
+    Telegram file_id store (memory + media_cache collection) in front of the
+    on-disk byte cache. A repeat of a cached generation is re-sent by file_id,
+    which uploads nothing.
+    """
+
+    def __init__(self):
+        self.disk = DiskLRUCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+        self._file_ids = OrderedDict()
+        self.file_id_hits = 0
+        self.generations = 0
+
+    async def get_file_id(self, key: str):
+        file_id = self._file_ids.get(key)
+        if file_id is None and is_db_connected():
+            try:
+                file_id = await repo.get_media_file_id(key)
+            except Exception as e:
+                logger.error(f"Error reading media cache: {e}")
+            if file_id:
+                self._remember(key, file_id)
+        return file_id
+
+    def _remember(self, key: str, file_id: str):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > 10000:
+            self._file_ids.popitem(last=False)
+
+    async def set_file_id(self, key: str, kind: str, file_id: str):
+        self._remember(key, file_id)
+        if is_db_connected():
+            try:
+                await repo.save_media_file_id(key, kind, file_id)
+            except Exception as e:
+                logger.error(f"Error saving media cache: {e}")
+
+    async def get_bytes(self, key: str, produce):
+        """Bytes from disk, or from `produce()` (which is then cached on disk)."""
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.disk.get, key)
+        if data is None:
+            data = await produce()
+            self.generations += 1
+            await loop.run_in_executor(None, self.disk.put, key, data)
+        return data
+
+    def stats(self) -> dict:
+        return {
+            "file_ids": len(self._file_ids),
+            "file_id_hits": self.file_id_hits,
+            "generations": self.generations,
+            "disk_hits": self.disk.hits,
+            "disk_misses": self.disk.misses,
+            "disk_bytes": self.disk.total_bytes,
+        }
+
+
+media_cache = MediaCache()
+
+def _sent_file_id(sent_message, kind: str):
+    if kind == "photo":
+        return sent_message.photo[-1].file_id if sent_message.photo else None
+    media = getattr(sent_message, kind, None)
+    return media.file_id if media else None
+
+async def reply_cached_media(message, key: str, kind: str, produce, filename: str = None,
+                             caption: str = None, cache_bytes: bool = True):
+    """
+    Sends a cached generation as `kind` ("photo", "audio" or "voice"): by
+    file_id when Telegram already has it, else from disk or `produce()`.
+    """
+    send = getattr(message, f"reply_{kind}")
+    file_id = await media_cache.get_file_id(key)
+    if file_id:
+        try:
+            sent = await send(file_id, caption=caption)
+            media_cache.file_id_hits += 1
+            return sent
+        except BadRequest as e:
+            logger.warning(f"Cached file_id rejected, re-uploading: {e}")
+    data = await media_cache.get_bytes(key, produce) if cache_bytes else await produce()
+    upload = io.BytesIO(data)
+    if filename:
+        upload.name = filename
+    sent = await send(upload, caption=caption)
+    new_file_id = _sent_file_id(sent, kind)
+    if new_file_id:
+        await media_cache.set_file_id(key, kind, new_file_id)
+    return sent
+
+# --- TTS PIPELINE (sentence chunks -> parallel synthesis -> OGG/Opus) ---
+_SENTENCE_END = re.compile(r"(?<=[.!?।…])\s+")
+
+def split_tts_text(text: str, max_chars: int = TTS_CHUNK_CHARS) -> list:
+    """Splits text at sentence boundaries into chunks of at most max_chars."""
+    chunks, current = [], ""
+    for sentence in _SENTENCE_END.split(normalize_prompt_text(text)):
+        while len(sentence) > max_chars:
+            # A single huge sentence: fall back to the last word break.
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+class OpusEncodeError(Exception):
+    """ffmpeg could not be started or failed to encode (e.g. built without libopus)."""
+
+
+async def _encode_opus_stream(pcm_tasks: list) -> bytes:
+    """
+    Feeds PCM chunks to ffmpeg in order as each synthesis finishes, so encoding
+    overlaps with the remaining TTS calls and the PCM is never concatenated.
+    ffmpeg failures raise OpusEncodeError; TTS errors propagate unchanged.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+            "-f", "s16le", "-ar", str(TTS_SAMPLE_RATE), "-ac", "1", "-i", "pipe:0",
+            "-c:a", "libopus", "-b:a", TTS_OPUS_BITRATE, "-application", "voip", "-f", "ogg", "pipe:1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        raise OpusEncodeError(f"could not start ffmpeg: {e}") from e
+    reader = asyncio.create_task(process.stdout.read())
+    errors = asyncio.create_task(process.stderr.read())
+    try:
+        for task in pcm_tasks:
+            pcm = await task
+            try:
+                process.stdin.write(pcm)
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                break  # ffmpeg exited early; its exit code and stderr say why
+        if not process.stdin.is_closing():
+            process.stdin.close()
+        ogg, stderr = await reader, await errors
+        if await process.wait() != 0:
+            raise OpusEncodeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace')[:300]}")
+        return ogg
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        reader.cancel()
+        errors.cancel()
+        raise
+
+async def synthesize_speech(text: str, voice: str = "kore"):
+    """
+    Runs TTS for every sentence chunk concurrently (bounded by the client's TTS
+    semaphore). Returns (data, kind): OGG/Opus for a voice note when ffmpeg is
+    available and works, otherwise a WAV file sent as audio.
+    """
+    chunks = split_tts_text(text) or [text]
+    pcm_tasks = [asyncio.ensure_future(gemini_tts(chunk, voice)) for chunk in chunks]
+    try:
+        if FFMPEG_PATH:
+            try:
+                return await _encode_opus_stream(pcm_tasks), "voice"
+            except OpusEncodeError as e:
+                logger.error(f"Opus encoding failed, sending WAV instead: {e}")
+        pcm_parts = [await task for task in pcm_tasks]
+        return pcm_to_wav(b"".join(pcm_parts)).getvalue(), "audio"
+    except BaseException:
+        for task in pcm_tasks:
+            task.cancel()
+        raise
+
+SPEECH_FORMATS = {"voice": ("ogg", "ananya_voice.ogg"), "audio": ("wav", "ananya_voice.wav")}
+
+class _SpeechFallback(Exception):
+    """Raised out of produce() when synthesis returned another format than the cache key's."""
+
+    def __init__(self, data: bytes, kind: str):
+        super().__init__(kind)
+        self.data = data
+        self.kind = kind
+
+
+async def reply_with_speech(message, text: str, voice: str = "kore"):
+    """
+    The /say path: a voice note for (text, voice), cached by content. If
+    ffmpeg fails, the WAV that synthesize_speech fell back to is sent (and
+    cached) as audio instead.
+    """
+    def cache_key(kind: str) -> str:
+        return media_cache_key("tts", GEMINI_TTS_MODEL, voice, text, SPEECH_FORMATS[kind][0])
+
+    kind = "voice" if FFMPEG_PATH else "audio"
+
+    async def produce():
+        data, produced_kind = await synthesize_speech(text, voice)
+        if produced_kind != kind:
+            raise _SpeechFallback(data, produced_kind)
+        return data
+
+    try:
+        return await reply_cached_media(message, cache_key(kind), kind, produce, filename=SPEECH_FORMATS[kind][1])
+    except _SpeechFallback as fallback:
+        data, kind = fallback.data, fallback.kind
+
+    async def produced():
+        return data
+
+    return await reply_cached_media(message, cache_key(kind), kind, produced, filename=SPEECH_FORMATS[kind][1])
+
+
+class PortraitPool:
+    """
+    Keeps PORTRAIT_POOL_SIZE pre-generated Ananya portraits on disk so
+    /send_image never waits for image generation. Each portrait is re-sent by
+    file_id after its first upload and retired after PORTRAIT_MAX_USES sends;
+    a background task tops the pool back up.
+    """
+
+    def __init__(self):
+        self.directory = os.path.join(MEDIA_CACHE_DIR, "portraits")
+        self._entries = None  # list of {"key", "path", "uses"}
+        self._replenish_task = None
+
+    def _load(self):
+        if self._entries is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._entries = [
+                {"key": f"portrait:{name[:-4]}", "path": os.path.join(self.directory, name), "uses": 0}
+                for name in sorted(os.listdir(self.directory)) if name.endswith(".png")
+            ]
+
+    async def _generate(self) -> dict:
+        data = await gemini_generate_image(ANANYA_PORTRAIT_PROMPT)
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.directory, f"{digest}.png")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write, path, data)
+        entry = {"key": f"portrait:{digest}", "path": path, "uses": 0}
+        self._entries.append(entry)
+        return entry
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def ensure_replenishing(self):
+        self._load()
+        if len(self._entries) < PORTRAIT_POOL_SIZE and (self._replenish_task is None or self._replenish_task.done()):
+            self._replenish_task = _spawn_background(self._replenish())
+
+    async def _replenish(self):
+        while len(self._entries) < PORTRAIT_POOL_SIZE:
+            try:
+                await self._generate()
+            except Exception as e:
+                logger.error(f"Error pre-generating portrait: {e}")
+                return
+
+    def _retire(self, entry: dict):
+        if entry in self._entries:
+            self._entries.remove(entry)
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            pass
+
+    async def reply_portrait(self, message, caption: str = None):
+        """The /send_image path."""
+        self._load()
+        entry = random.choice(self._entries) if self._entries else await self._generate()
+        entry["uses"] += 1
+        loop = asyncio.get_running_loop()
+
+        async def produce():
+            return await loop.run_in_executor(None, lambda: open(entry["path"], "rb").read())
+
+        try:
+            # The pool file already is the on-disk copy.
+            return await reply_cached_media(message, entry["key"], "photo", produce, caption=caption, cache_bytes=False)
+        finally:
+            if entry["uses"] >= PORTRAIT_MAX_USES:
+                self._retire(entry)
+            self.ensure_replenishing()
+
+
+portrait_pool = PortraitPool()
+
+
+# --- VISION IMAGE PREPROCESSING ---
+def pick_photo_size(photos):
+    """
+    Smallest PhotoSize whose longest side still covers VISION_MAX_EDGE, or the
+    largest one when every size is smaller. Telegram lists sizes ascending.
+    """
+    for photo in sorted(photos, key=lambda p: max(p.width, p.height)):
+        if max(photo.width, photo.height) >= VISION_MAX_EDGE:
+            return photo
+    return max(photos, key=lambda p: max(p.width, p.height))
+
+def encode_vision_image(raw) -> tuple:
+    """
+    Downscales to VISION_MAX_EDGE and re-encodes at VISION_IMAGE_QUALITY.
+    A JPEG that is already small enough is passed through untouched. Base64
+    is taken straight from the output buffer, without an extra bytes copy.
+
+    Returns (base64_str, mime_type, output_size).
+    """
+    with Image.open(io.BytesIO(raw)) as image:
+        if image.format == "JPEG" and max(image.size) <= VISION_MAX_EDGE and VISION_IMAGE_FORMAT == "JPEG":
+            return base64.b64encode(raw).decode("ascii"), "image/jpeg", len(raw)
+        image.draft("RGB", (VISION_MAX_EDGE, VISION_MAX_EDGE))  # cheap JPEG DCT downscale first
+        image.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format=VISION_IMAGE_FORMAT, quality=VISION_IMAGE_QUALITY)
+    view = buffer.getbuffer()
+    try:
+        return base64.b64encode(view).decode("ascii"), f"image/{VISION_IMAGE_FORMAT.lower()}", view.nbytes
+    finally:
+        view.release()
+
+async def prepare_vision_part(photos) -> dict:
+    """
+    Downloads the best-fitting PhotoSize and turns it into a Gemini
+    inline_data part. Resizing runs off the event loop; sizes and timings are
+    logged so VISION_MAX_EDGE / VISION_IMAGE_QUALITY can be tuned.
+    """
+    photo = pick_photo_size(photos)
+    started = time.perf_counter()
+    file = await photo.get_file()
+    raw = await file.download_as_bytearray()
+    downloaded = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    data, mime_type, size = await loop.run_in_executor(None, encode_vision_image, raw)
+    encoded = time.perf_counter()
+    logger.info(
+        f"Vision image {photo.width}x{photo.height}: {len(raw)} -> {size} bytes "
+        f"({len(data)} base64), download {(downloaded - started) * 1000:.0f}ms, "
+        f"encode {(encoded - downloaded) * 1000:.0f}ms"
+    )
+    return {"inline_data": {"mime_type": mime_type, "data": data}}
+
+
+# --- STREAMED CHAT REPLIES ---
+def _split_point(text: str, limit: int) -> int:
+    """Where to cut `text` so the first piece fits in `limit` chars, preferring line/word breaks."""
+    if len(text) <= limit:
+        return len(text)
+    for separator in ("\n", " "):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut != -1:
+            return cut + 1
+    return limit
+
+async def _safe_edit(message, text: str) -> float:
+    """Edits a message, returning extra seconds to wait before the next edit."""
+    try:
+        await message.edit_text(text)
+    except RetryAfter as e:
+        delay = e.retry_after
+        return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.warning(f"Could not edit streamed reply: {e}")
+    return 0.0
+
+async def stream_reply(message, chunks):
+    """
+    Replies to `message` with a placeholder and progressively edits it as
+    `chunks` arrive. Edits are coalesced to one per STREAM_EDIT_INTERVAL and
+    the reply continues in a new message whenever it passes 4096 characters.
+
+    Returns (full_text, completed); completed is False if the stream failed.
+    """
+    current = await message.reply_text("…")
+    full_text = ""
+    offset = 0  # start of the text shown in `current`
+    shown = ""
+    next_edit_at = 0.0
+    completed = False
+    try:
+        async for chunk in chunks:
+            full_text += chunk
+            while len(full_text) - offset > TELEGRAM_MESSAGE_LIMIT:
+                cut = offset + _split_point(full_text[offset:], TELEGRAM_MESSAGE_LIMIT)
+                await _safe_edit(current, full_text[offset:cut])
+                offset = cut
+                # The remainder may itself be over the limit; the loop keeps splitting it.
+                shown = full_text[offset:offset + TELEGRAM_MESSAGE_LIMIT]
+                current = await message.reply_text(shown or "…")
+                next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+            pending = full_text[offset:]
+            if pending and pending != shown and time.monotonic() >= next_edit_at:
+                backoff = await _safe_edit(current, pending)
+                shown = pending
+                next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL + backoff
+        completed = True
+    except Exception as e:
+        logger.error(f"Streaming reply failed: {e}")
+    pending = full_text[offset:]
+    if not full_text:
+        pending = "Sorry, I couldn't come up with a reply just now. Please try again."
+    elif not completed:
+        pending += " …"
+    if pending != shown:
+        await _safe_edit(current, pending)
+    return full_text, completed
+
+async def stream_chat_reply(message, chat_id: int, user_turn: dict, personality_prompt: str) -> str:
+    """
+    The streaming chat path: builds the budgeted context, streams Gemini's
+    answer into progressively edited messages, and saves both turns to history
+    once the stream has completed.
+    """
+    contents, system_prompt = await prepare_chat_context(chat_id, [user_turn], personality_prompt)
+    has_image = any("inline_data" in part or "inlineData" in part for part in user_turn.get("parts", []))
+    chunks = gemini_chat_stream(contents, system_prompt, kind="vision" if has_image else "text")
+    reply_text, completed = await stream_reply(message, chunks)
+    if completed and reply_text:
+        await repo.append_chat_history(chat_id, [user_turn, {"role": "model", "parts": [{"text": reply_text}]}])
+    return reply_text
+
+
+# --- BROADCAST ENGINE ---
+class TokenBucket:
+    """Token bucket usable from async code (acquire) or as a non-blocking check (try_acquire)."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if time.monotonic() < self.paused_until or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self):
+        while not self.try_acquire():
+            wait = max(self.paused_until - time.monotonic(), (1 - self.tokens) / self.rate, 0.01)
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens, e.g. after Telegram answers with RetryAfter."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class BroadcastEngine:
+    """
+    Runs broadcasts as background jobs persisted in the broadcast_jobs collection.
+
+    User IDs are streamed from MongoDB in _id order, sent with bounded
+    concurrency under a global token bucket, and the last completed _id is
+    checkpointed after every batch so a restarted worker resumes from there.
+    Each job is owned by one worker under a lease (owner + lease_until) that a
+    heartbeat task renews while the job runs, even through long flood-control
+    pauses; other workers only take over once it expires. If renewal fails
+    for too long, or another worker took the job, sending stops before the
+    lease can run out, so a job never runs in two workers at once. Users who
+    blocked the bot (Forbidden) are removed from the users collection.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(BROADCAST_RATE_PER_SEC, BROADCAST_RATE_PER_SEC)
+        self._tasks = {}  # job_id -> asyncio.Task
+
+    async def start(self, bot, text: str, photo: str, caption: str, requested_by: int) -> str:
+        job_id = await repo.create_broadcast_job(text, photo, caption, requested_by)
+        job = await repo.get_broadcast_job(job_id)
+        self._launch(bot, job)
+        return job_id
+
+    async def resume_pending(self, bot):
+        """Claims and restarts every running job whose owner's lease has expired."""
+        try:
+            while True:
+                job = await repo.claim_broadcast_job()
+                if job is None:
+                    break
+                if str(job["_id"]) in self._tasks:
+                    continue
+                logger.info(f"Resuming broadcast {job['_id']} after user {job.get('last_user_id')}")
+                self._launch(bot, job)
+        except Exception as e:
+            logger.error(f"Error resuming broadcasts: {e}")
+
+    async def run_resumer(self, bot):
+        """Background loop: picks up jobs orphaned by a worker that died while others kept running."""
+        while True:
+            await self.resume_pending(bot)
+            await asyncio.sleep(BROADCAST_LEASE_SECONDS / 2)
+
+    def _launch(self, bot, job: dict):
+        job_id = str(job["_id"])
+        task = asyncio.create_task(self._run(bot, job))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _heartbeat(self, job_id: str, lease: dict):
+        """Renews the job's lease until cancelled or until another worker owns it."""
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE_SECONDS / 4)
+            started = time.monotonic()
+            try:
+                if not await repo.renew_broadcast_lease(job_id):
+                    lease["lost"] = True
+                    return
+                lease["renewed_at"] = started
+            except Exception as e:
+                logger.error(f"Error renewing lease for broadcast {job_id}: {e}")
+
+    @staticmethod
+    def _still_owned(lease: dict) -> bool:
+        # Stop well before the stored lease_until, leaving room for clock skew.
+        return not lease["lost"] and time.monotonic() - lease["renewed_at"] < BROADCAST_LEASE_SECONDS * 3 / 4
+
+    async def _run(self, bot, job: dict):
+        job_id = str(job["_id"])
+        last_user_id = job.get("last_user_id")
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        lease = {"renewed_at": time.monotonic(), "lost": False}
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, lease))
+
+        async def send_limited(user_id_str):
+            async with semaphore:
+                return await self._send_one(bot, job, user_id_str, lease)
+
+        try:
+            while True:
+                batch = await repo.fetch_broadcast_batch(last_user_id, BROADCAST_BATCH_SIZE)
+                if not batch:
+                    break
+                results = await asyncio.gather(*(send_limited(uid) for uid in batch))
+                if not self._still_owned(lease):
+                    # Only reached when renewals kept failing: the next owner resumes
+                    # from the last checkpoint, so this partial batch may be resent.
+                    logger.warning(f"Broadcast {job_id} lost its lease, stopping here.")
+                    return
+                counts = {key: results.count(key) for key in ("sent", "failed", "removed")}
+                last_user_id = batch[-1]
+                checkpoint_started = time.monotonic()
+                if not await repo.checkpoint_broadcast_job(job_id, last_user_id, counts):
+                    logger.warning(f"Broadcast {job_id} was taken over by another worker, stopping here.")
+                    return
+                lease["renewed_at"] = max(lease["renewed_at"], checkpoint_started)
+            await repo.checkpoint_broadcast_job(job_id, last_user_id, {}, status="done")
+            logger.info(f"Broadcast {job_id} finished.")
+            log_to_channel(f"Broadcast {job_id} finished.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {job_id} stopped: {e}")
+            log_to_channel(f"Broadcast {job_id} stopped: {e}", "error")
+            try:
+                await repo.checkpoint_broadcast_job(job_id, last_user_id, {}, status="failed")
+            except Exception:
+                pass
+        finally:
+            heartbeat.cancel()
+
+    async def _send_one(self, bot, job: dict, user_id_str: str, lease: dict) -> str:
+        try:
+            user_id = int(user_id_str)
+        except ValueError:
+            return "failed"
+        if user_id == ADMIN_USER_ID:
+            return "sent"
+        for attempt in range(3):
+            await self.bucket.acquire()
+            if not self._still_owned(lease):
+                return "skipped"
+            try:
+                if job.get("text"):
+                    await bot.send_message(chat_id=user_id, text=job["text"])
+                else:
+                    await bot.send_photo(chat_id=user_id, photo=job["photo"], caption=job.get("caption"))
+                return "sent"
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+                logger.warning(f"Broadcast hit flood control, pausing {delay}s")
+                self.bucket.pause(delay)
+            except Forbidden:
+                logger.warning(f"Broadcast failed for user {user_id}: Bot was blocked. Removing user.")
+                try:
+                    await repo.remove_user(user_id_str)
+                except Exception as e:
+                    logger.error(f"Error removing user {user_id}: {e}")
+                return "removed"
+            except Exception as e:
+                logger.warning(f"Broadcast failed for user {user_id}: {e}")
+                return "failed"
+        return "failed"
+
+    def running_jobs(self) -> list:
+        return list(self._tasks)
+
+
+broadcast_engine = BroadcastEngine()
+
+def get_broadcast_progress(limit: int = 5) -> list:
+    """Recent broadcast jobs with their counters, for the dashboard."""
     if not is_db_connected():
-        return False # Fail safe: if DB is down, bot is off
+        return []
     try:
-        status = status_col.find_one({"_id": "global_status"})
-        if status is None:
-            # If no status is set, default to ON
-            set_bot_status(True)
-            return True
-        return status.get("is_on", True)
+        jobs = get_broadcast_jobs(limit)
     except Exception as e:
-        logger.error(f"Error getting bot status: {e}")
-        return False # Fail safe
+        logger.error(f"Error fetching broadcast progress: {e}")
+        return []
+    return [
+        {
+            "id": str(job["_id"]),
+            "status": job.get("status"),
+            "sent": job.get("sent", 0),
+            "failed": job.get("failed", 0),
+            "removed": job.get("removed", 0),
+            "total_estimate": job.get("total_estimate", 0),
+            "created_at": job.get("created_at"),
+            "updated_at": job.get("updated_at"),
+        }
+        for job in jobs
+    ]
 
 
-# --- (All other database functions: log_user, is_user_blocked, etc. are unchanged) ---
-def log_user(user: Update.effective_user):
-    if not user or not is_db_connected():
-        return
-    try:
-        user_id_str = str(user.id)
-        if user.id < 0:
+def is_admin(user_id: int) -> bool:
+    return user_id == ADMIN_USER_ID
+
+
+# --- LOG CHANNEL SINK ---
+class LogChannelSink:
+    """
+    Batches events for the private log channel (LOG_CHANNEL_ID) off the
+    request path.
+
+    emit() only appends to an in-memory buffer and never awaits, so it is safe
+    from handlers and worker threads alike. A background task on the bot's
+    loop packs as many events as fit into one 4096-char message and sends at
+    most LOG_CHANNEL_RATE_PER_MIN messages. Errors have their own queue and are
+    never dropped; when the normal buffer is full, low-priority events
+    ("sample", "image") go first and the drops are summarized in the next
+    message.
+    """
+
+    LOW_PRIORITY = ("sample", "image")
+    ICONS = {"error": "🚨", "activity": "📝", "sample": "💬", "image": "🎨"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._errors = []
+        self._events = []  # (priority, text)
+        self._bot = None
+        self._task = None
+        self.bucket = TokenBucket(LOG_CHANNEL_RATE_PER_MIN / 60, 3)
+        self.dropped = 0
+        self.sent_messages = 0
+        self.sent_events = 0
+
+    def emit(self, text: str, priority: str = "activity"):
+        if LOG_CHANNEL_ID is None:
             return
-        update_data = {
-            "$set": {
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_seen": logging.Formatter().formatTime(logging.makeLogRecord({})),
+        line = f"{self.ICONS.get(priority, '•')} {text}"
+        with self._lock:
+            if priority == "error":
+                self._errors.append(line)
+                return
+            if len(self._events) >= LOG_SINK_MAX_EVENTS:
+                victim = next((i for i, (p, _) in enumerate(self._events) if p in self.LOW_PRIORITY), None)
+                if victim is None and priority in self.LOW_PRIORITY:
+                    self.dropped += 1
+                    return
+                self._events.pop(victim if victim is not None else 0)
+                self.dropped += 1
+            self._events.append((priority, line))
+
+    def _take_batch(self) -> list:
+        """Pops as many events as fit in one Telegram message (errors first)."""
+        with self._lock:
+            lines, length = [], 0
+            if self.dropped:
+                lines.append(f"⚠️ {self.dropped} low-priority log events were dropped under load.")
+                length = len(lines[0])
+                self.dropped = 0
+            taken_errors = 0
+            for line in self._errors:
+                line = line[:TELEGRAM_MESSAGE_LIMIT - 10]
+                if length + len(line) + 2 > TELEGRAM_MESSAGE_LIMIT:
+                    break
+                lines.append(line)
+                length += len(line) + 2
+                taken_errors += 1
+            del self._errors[:taken_errors]
+            taken_events = 0
+            for _, line in self._events:
+                line = line[:TELEGRAM_MESSAGE_LIMIT - 10]
+                if length + len(line) + 2 > TELEGRAM_MESSAGE_LIMIT:
+                    break
+                lines.append(line)
+                length += len(line) + 2
+                taken_events += 1
+            del self._events[:taken_events]
+            return lines
+
+    def _requeue_errors(self, lines: list):
+        with self._lock:
+            self._errors = [line for line in lines if line.startswith(self.ICONS["error"])] + self._errors
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._errors) + len(self._events)
+
+    async def _drain(self):
+        while True:
+            if not self.pending():
+                await asyncio.sleep(1)
+                continue
+            await self.bucket.acquire()
+            await self.flush_once()
+
+    async def flush_once(self):
+        lines = self._take_batch()
+        if not lines:
+            return
+        try:
+            await self._bot.send_message(chat_id=LOG_CHANNEL_ID, text="\n\n".join(lines), disable_web_page_preview=True)
+            self.sent_messages += 1
+            self.sent_events += len(lines)
+        except RetryAfter as e:
+            delay = e.retry_after
+            self.bucket.pause(delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay))
+            self._requeue_errors(lines)
+        except Exception as e:
+            logger.error(f"Error sending to log channel: {e}")
+            self._requeue_errors(lines)
+            await asyncio.sleep(5)
+
+    def start(self, bot):
+        """Starts the drain task on the running loop (the webhook ingestor's)."""
+        if LOG_CHANNEL_ID is None or self._task is not None:
+            return
+        self._bot = bot
+        self._task = asyncio.create_task(self._drain())
+
+    async def close(self, timeout: float = 5):
+        """Best-effort flush of what is left, used at shutdown."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            await self.flush_once()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending_errors": len(self._errors),
+                "pending_events": len(self._events),
+                "dropped": self.dropped,
+                "sent_messages": self.sent_messages,
+                "sent_events": self.sent_events,
             }
-        }
-        users_col.update_one({"_id": user_id_str}, update_data, upsert=True)
-    except Exception as e:
-        logger.error(f"Error in log_user: {e}")
 
-def is_user_blocked(user_id: int) -> bool:
-    if is_admin(user_id) or not is_db_connected():
-        return False
-    try:
-        return blocked_col.find_one({"_id": str(user_id)}) is not None
-    except Exception as e:
-        logger.error(f"Error in is_user_blocked: {e}")
-        return False
 
-def block_user(user_id_to_block: int) -> str:
-    if not is_db_connected():
-        return "Database error."
-    if is_admin(user_id_to_block):
-        return "Cannot block the admin."
-    try:
-        blocked_col.update_one(
-            {"_id": str(user_id_to_block)}, {"$set": {"blocked": True}}, upsert=True
+log_sink = LogChannelSink()
+
+def log_to_channel(text: str, priority: str = "activity"):
+    """Queues an event for the log channel; never blocks the caller."""
+    log_sink.emit(text, priority)
+
+def log_message_sample(user, chat_id: int, text: str):
+    """Mirrors roughly LOG_SAMPLE_RATE of chat messages to the log channel."""
+    if user and random.random() < LOG_SAMPLE_RATE:
+        log_to_channel(f"{user.first_name} ({user.id}) in {chat_id}: {(text or '')[:300]}", "sample")
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Application-wide error handler: log locally and (never dropped) to the channel."""
+    logger.error(f"Unhandled error while processing an update: {context.error}")
+    where = ""
+    if isinstance(update, Update) and update.effective_user:
+        where = f" (user {update.effective_user.id}, chat {update.effective_chat.id if update.effective_chat else '?'})"
+    log_to_channel(f"Error{where}: {type(context.error).__name__}: {context.error}", "error")
+
+
+# --- FORCE-JOIN MEMBERSHIP CACHE ---
+class MembershipCache:
+    """
+    Caches whether a user has joined both GROUP_USERNAME and CHANNEL_USERNAME.
+
+    Lookups go memory -> membership_cache collection -> Telegram. A miss asks
+    Telegram about both chats concurrently, and concurrent misses for the same
+    user share one verification. "Joined" results live MEMBERSHIP_POSITIVE_TTL,
+    "not joined" only MEMBERSHIP_NEGATIVE_TTL. Results are persisted so a
+    restart starts warm; chat_member updates from the two chats invalidate
+    entries as soon as somebody joins or leaves.
+    """
+
+    JOINED = (ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+    def __init__(self):
+        self._entries = OrderedDict()  # user_id -> (is_member, expires_at monotonic)
+        self._inflight = {}  # user_id -> asyncio.Future
+        self.hits = 0
+        self.db_hits = 0
+        self.api_checks = 0
+
+    def _remember(self, user_id: int, is_member: bool, ttl: float):
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > MEMBERSHIP_CACHE_SIZE:
+            self._entries.popitem(last=False)
+
+    def _cached(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            self._entries.pop(user_id, None)
+            return None
+        return entry[0]
+
+    @classmethod
+    def _is_joined(cls, member) -> bool:
+        if member.status == ChatMember.RESTRICTED:
+            return bool(getattr(member, "is_member", False))
+        return member.status in cls.JOINED
+
+    NOT_PARTICIPANT_ERRORS = ("user not found", "participant_id_invalid", "user_not_participant")
+
+    @classmethod
+    def _is_not_participant(cls, error: BadRequest) -> bool:
+        message = str(error).lower()
+        return any(marker in message for marker in cls.NOT_PARTICIPANT_ERRORS)
+
+    async def _ask_telegram(self, bot, user_id: int):
+        """True/False, or None when Telegram can't tell us (nothing is cached then)."""
+        self.api_checks += 1
+        results = await asyncio.gather(
+            bot.get_chat_member(GROUP_USERNAME, user_id),
+            bot.get_chat_member(CHANNEL_USERNAME, user_id),
+            return_exceptions=True,
         )
-        return f"User {user_id_to_block} has been blocked."
-    except Exception as e:
-        logger.error(f"Error in block_user: {e}")
-        return "An error occurred while blocking."
+        joined = True
+        for chat, result in zip((GROUP_USERNAME, CHANNEL_USERNAME), results):
+            if isinstance(result, BadRequest) and self._is_not_participant(result):
+                joined = False  # never joined this chat
+            elif isinstance(result, Exception):
+                # Includes "member list is inaccessible" / "chat not found": a
+                # misconfigured bot must not lock everyone out.
+                logger.error(f"Error checking membership of {user_id} in {chat}: {result}")
+                return None
+            elif not self._is_joined(result):
+                joined = False
+        return joined
 
-def unblock_user(user_id_to_unblock: int) -> str:
-    if not is_db_connected():
-        return "Database error."
-    try:
-        result = blocked_col.delete_one({"_id": str(user_id_to_unblock)})
-        if result.deleted_count > 0:
-            return f"User {user_id_to_unblock} has been unblocked."
-        else:
-            return f"User {user_id_to_unblock} was not in the block list."
-    except Exception as e:
-        logger.error(f"Error in unblock_user: {e}")
-        return "An error occurred while unblocking."
+    async def _verify(self, bot, user_id: int) -> bool:
+        try:
+            stored = await repo.get_membership(user_id)
+        except Exception as e:
+            logger.error(f"Error reading membership cache for {user_id}: {e}")
+            stored = None
+        if stored is not None:
+            is_member, expires_at = stored
+            self.db_hits += 1
+            self._remember(user_id, is_member, (expires_at - datetime.now(timezone.utc)).total_seconds())
+            return is_member
 
-def update_active_chats(chat_id: int, action: str = "add"):
-    if not is_db_connected():
-        return
-    try:
-        if action == "add":
-            chats_col.update_one(
-                {"_id": chat_id}, {"$set": {"active": True}}, upsert=True
-            )
-        elif action == "remove":
-            chats_col.delete_one({"_id": chat_id})
-    except Exception as e:
-        logger.error(f"Error in update_active_chats: {e}")
+        is_member = await self._ask_telegram(bot, user_id)
+        if is_member is None:
+            return True  # fail open: a Telegram hiccup shouldn't lock everyone out
+        await self.record(user_id, is_member)
+        return is_member
 
-CHAT_HISTORY_LIMIT = 20
-def get_chat_history(chat_id: int) -> list:
-    if not is_db_connected():
-        return []
-    try:
-        chat_doc = history_col.find_one({"_id": chat_id})
-        if chat_doc:
-            return chat_doc.get("history", [])
-        return []
-    except Exception as e:
-        logger.error(f"Error getting chat history: {e}")
-        return []
+    async def is_member(self, bot, user_id: int) -> bool:
+        cached = self._cached(user_id)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        pending = self._inflight.get(user_id)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # this caller was cancelled, not the check it waited on
+                # The caller running the check was cancelled; run it ourselves.
+                return await self.is_member(bot, user_id)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        try:
+            result = await self._verify(bot, user_id)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            if not future.done():
+                future.cancel()  # cancelled mid-check: wake the waiters so they retry
+            self._inflight.pop(user_id, None)
 
-def save_chat_history(chat_id: int, history: list):
-    if not is_db_connected():
+    async def record(self, user_id: int, is_member: bool):
+        """Stores a verified result in memory and in the collection."""
+        ttl = MEMBERSHIP_POSITIVE_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL
+        self._remember(user_id, is_member, ttl)
+        try:
+            await repo.save_membership(user_id, is_member, datetime.now(timezone.utc) + timedelta(seconds=ttl))
+        except Exception as e:
+            logger.error(f"Error saving membership cache for {user_id}: {e}")
+
+    async def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+        try:
+            await repo.delete_membership(user_id)
+        except Exception as e:
+            logger.error(f"Error invalidating membership cache for {user_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "api_checks": self.api_checks,
+        }
+
+
+membership_cache = MembershipCache()
+
+def _is_force_join_chat(chat) -> bool:
+    username = f"@{chat.username}".lower() if chat.username else None
+    return username in (GROUP_USERNAME.lower(), CHANNEL_USERNAME.lower())
+
+async def track_force_join_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    chat_member updates from the force-join chats. Leaving is recorded as
+    "not joined" right away; joining drops the entry so the next request
+    re-checks both chats. Needs "chat_member" in the webhook's allowed_updates
+    and the bot to be an admin in both chats.
+    """
+    change = update.chat_member
+    if not change or not _is_force_join_chat(change.chat):
         return
-    try:
-        if len(history) > CHAT_HISTORY_LIMIT:
-            history = history[-CHAT_HISTORY_LIMIT:]
-        history_col.update_one(
-            {"_id": chat_id}, {"$set": {"history": history}}, upsert=True
+    user_id = change.new_chat_member.user.id
+    if MembershipCache._is_joined(change.new_chat_member):
+        await membership_cache.invalidate(user_id)
+    else:
+        await membership_cache.record(user_id, False)
+
+def force_join_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Join Group", url=f"https://t.me/{GROUP_USERNAME.lstrip('@')}")],
+        [InlineKeyboardButton("Join Channel", url=f"https://t.me/{CHANNEL_USERNAME.lstrip('@')}")],
+    ])
+
+async def ensure_joined(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Force-join gate for user-facing handlers; replies with join links when needed."""
+    user = update.effective_user
+    if not user or is_admin(user.id):
+        return True
+    if await membership_cache.is_member(context.bot, user.id):
+        return True
+    if update.effective_message:
+        await update.effective_message.reply_text(
+            "Please join our group and channel to use me, then try again. 💖",
+            reply_markup=force_join_keyboard(),
         )
-    except Exception as e:
-        logger.error(f"Error saving chat history: {e}")
+    return False
+
+
+# --- PER-CHAT JOB SCHEDULER ---
+class SchedulerBusy(Exception):
+    """The queue for this job class is full."""
+
+
+class RateLimited(Exception):
+    """The user has used up their token bucket."""
+
+
+class ChatScheduler:
+    """
+    Runs handler jobs so that work for one chat_id happens strictly in arrival
+    order (no races on chat history), while different chats run in parallel.
+
+    Jobs are classed as "text", "vision", "tts" or "image"; each class has its
+    own worker limit and queue limit, so a burst of /gen_image cannot starve
+    plain chat replies. Each user also has a token bucket.
+    """
+
+    def __init__(self, workers: dict, queue_limits: dict):
+        self.workers = workers
+        self.queue_limits = queue_limits
+        self._semaphores = None
+        self._chat_tails = {}  # chat_id -> last scheduled task for that chat
+        self._user_buckets = OrderedDict()
+        self.pending = {kind: 0 for kind in workers}
+        self.completed = {kind: 0 for kind in workers}
+        self.rejected_busy = {kind: 0 for kind in workers}
+        self.rejected_rate = 0
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self._user_buckets[user_id] = TokenBucket(USER_RATE_PER_SEC, USER_RATE_BURST)
+            while len(self._user_buckets) > 50000:
+                self._user_buckets.popitem(last=False)
+        else:
+            self._user_buckets.move_to_end(user_id)
+        return bucket
+
+    def submit(self, chat_id: int, user_id, kind: str, job) -> asyncio.Task:
+        """
+        Schedules `job` (a zero-argument coroutine function) behind earlier jobs
+        of the same chat. Raises RateLimited or SchedulerBusy instead of queueing.
+        """
+        if self._semaphores is None:
+            self._semaphores = {k: asyncio.Semaphore(limit) for k, limit in self.workers.items()}
+        if user_id is not None and not is_admin(user_id) and not self._bucket(user_id).try_acquire():
+            self.rejected_rate += 1
+            raise RateLimited()
+        if self.pending[kind] >= self.queue_limits[kind]:
+            self.rejected_busy[kind] += 1
+            raise SchedulerBusy()
+        self.pending[kind] += 1
+        previous = self._chat_tails.get(chat_id)
+        task = asyncio.create_task(self._run(previous, kind, job))
+        self._chat_tails[chat_id] = task
+        task.add_done_callback(lambda done: self._chat_tails.pop(chat_id, None) if self._chat_tails.get(chat_id) is done else None)
+        return task
+
+    async def _run(self, previous, kind: str, job):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self._semaphores[kind]:
+                await job()
+            self.completed[kind] += 1
+        except Exception as e:
+            logger.error(f"Error in scheduled {kind} job: {e}")
+            log_to_channel(f"Error in scheduled {kind} job: {type(e).__name__}: {e}", "error")
+        finally:
+            self.pending[kind] -= 1
+
+    def stats(self) -> dict:
+        return {
+            "pending": dict(self.pending),
+            "completed": dict(self.completed),
+            "rejected_busy": dict(self.rejected_busy),
+            "rejected_rate": self.rejected_rate,
+            "active_chats": len(self._chat_tails),
+        }
+
+
+chat_scheduler = ChatScheduler(SCHEDULER_WORKERS, SCHEDULER_QUEUE_LIMITS)
+
+BUSY_REPLY = "I'm getting a lot of requests right now 😅 Please try again in a minute!"
+RATE_LIMITED_REPLY = "Whoa, slow down a little! 🙈 Give me a few seconds and try again."
+
+def scheduled(kind: str):
+    """
+    Decorator that runs a handler through chat_scheduler instead of inline.
+    kind="auto" picks "vision" for photo messages and "text" otherwise.
+    The handler returns as soon as the job is queued; errors raised by the
+    job go to the application's error handlers like inline handler errors.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            chat, user = update.effective_chat, update.effective_user
+            if chat is None:
+                return await handler(update, context)
+            job_kind = kind
+            if kind == "auto":
+                job_kind = "vision" if update.effective_message and update.effective_message.photo else "text"
+            async def job():
+                try:
+                    await handler(update, context)
+                except Exception as e:
+                    await context.application.process_error(update, e)
+
+            try:
+                chat_scheduler.submit(chat.id, user.id if user else None, job_kind, job)
+            except (SchedulerBusy, RateLimited) as e:
+                reply = BUSY_REPLY if isinstance(e, SchedulerBusy) else RATE_LIMITED_REPLY
+                if update.effective_message:
+                    try:
+                        await update.effective_message.reply_text(reply)
+                    except Exception as send_error:
+                        logger.warning(f"Could not send busy reply: {send_error}")
+        return wrapper
+    return decorator
 
 
 # --- TELEGRAM COMMAND HANDLERS (Unchanged, but now async) ---
 # --- (admin_panel, admin_stats, block_command, unblock_command...) ---
+@track_latency("admin_panel")
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text(
@@ -288,11 +3397,14 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• <code>/block &lt;user_id&gt;</code> - Blocks a user from the bot.\n"
         "• <code>/unblock &lt;user_id&gt;</code> - Unblocks a user.\n\n"
         "<b>Bot Stats:</b>\n"
-        "• <code>/admin_stats</code> - Shows usage statistics.\n\n"
+        "• <code>/admin_stats</code> - Shows usage statistics.\n"
+        "• <code>/admin_logs [page_size]</code> - Recent activity logs (paged).\n"
+        "• <code>/admin_user_logs &lt;user_id&gt; [page_size]</code> - Activity logs for one user.\n\n"
         "<b>Content Management:</b>\n"
         "• <code>/news [query]</code> - Fetches verified news. \n"
         "• <code>/broadcast &lt;text&gt;</code> - Sends text to all users.\n"
-        "• <code>/broadcast</code> (as caption) - Sends a photo and caption to all users.\n\n"
+        "• <code>/broadcast</code> (as caption) - Sends a photo and caption to all users.\n"
+        "• <code>/broadcast_status [job_id]</code> - Shows broadcast progress.\n\n"
         "<b>Personality Management: (NOW SAVED TO DB)</b>\n"
         "• <code>/admin_get_prompt &lt;name&gt;</code> - Shows prompt for 'default', 'spiritual', or any custom name.\n"
         "• <code>/admin_set_prompt &lt;name&gt; &lt;text&gt;</code> - Sets a new persistent prompt for a personality.\n"
@@ -301,6 +3413,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
 
 
+@track_latency("admin_stats")
 async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text(
@@ -311,14 +3424,17 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Error: Database is not connected.")
         return
     try:
-        total_users = users_col.count_documents({})
-        total_blocked = blocked_col.count_documents({})
-        total_chats = chats_col.count_documents({})
+        stats = await repo.get_bot_stats()
+        total_users = stats["total_users"]
+        total_blocked = stats["total_blocked"]
+        total_chats = stats["total_chats"]
         stats_text = (
             f"<b>Bot Statistics</b>\n"
             f"• <b>Total Unique Users:</b> {total_users}\n"
             f"• <b>Total Blocked Users:</b> {total_blocked}\n"
-            f"• <b>Total Active Chats (Groups + Private):</b> {total_chats}"
+            f"• <b>Total Active Chats (Groups + Private):</b> {total_chats}\n"
+            f"• <b>Active Users Today:</b> {stats['active_today']}\n"
+            f"• <b>Messages Today:</b> {stats['messages_today']}"
         )
         await update.message.reply_text(stats_text, parse_mode=ParseMode.HTML)
     except Exception as e:
@@ -326,6 +3442,7 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Error fetching stats.")
 
 
+@track_latency("block")
 async def block_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text(
@@ -334,12 +3451,13 @@ async def block_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         user_id_to_block = int(context.args[0])
-        message = block_user(user_id_to_block) # This is a sync function, no await needed
+        message = await repo.block_user(user_id_to_block)
         await update.message.reply_text(message)
     except (IndexError, ValueError):
         await update.message.reply_text("Usage: /block <user_id>")
 
 
+@track_latency("unblock")
 async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text(
@@ -348,11 +3466,12 @@ async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         user_id_to_unblock = int(context.args[0])
-        message = unblock_user(user_id_to_unblock) # This is a sync function, no await needed
+        message = await repo.unblock_user(user_id_to_unblock)
         await update.message.reply_text(message)
     except (IndexError, ValueError):
         await update.message.reply_text("Usage: /unblock <user_id>")
 
+@track_latency("admin_get_prompt")
 async def admin_get_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text(
@@ -366,11 +3485,11 @@ async def admin_get_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         personality_name = context.args[0].lower()
         
-        # Check DB first
-        prompt_doc = prompts_col.find_one({"_id": personality_name})
+        # Check DB first (served from the hot config cache)
+        db_prompt = await run_db("get_prompt", hot_config.get_prompt, personality_name)
         
-        if prompt_doc:
-            prompt_text = prompt_doc["prompt"]
+        if db_prompt:
+            prompt_text = db_prompt
             source = "(from Database)"
         # Fallback to local default
         elif personality_name in PERSONALITIES:
@@ -392,6 +3511,7 @@ async def admin_get_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"An error occurred: {e}")
 
 
+@track_latency("admin_set_prompt")
 async def admin_set_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text(
@@ -411,11 +3531,7 @@ async def admin_set_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             
         # Save the new prompt to MongoDB
-        prompts_col.update_one(
-            {"_id": personality_name}, 
-            {"$set": {"prompt": new_prompt}}, 
-            upsert=True
-        )
+        await repo.save_prompt(personality_name, new_prompt)
         
         await update.message.reply_text(
             f"Successfully saved new persistent prompt for '{personality_name}' to the database.\n"
@@ -430,6 +3546,7 @@ async def admin_set_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in admin_set_prompt: {e}")
         await update.message.reply_text(f"An error occurred while saving: {e}")
 
+@track_latency("admin_delete_prompt")
 async def admin_delete_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text(
@@ -449,9 +3566,9 @@ async def admin_delete_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
             
         # Delete the prompt from MongoDB
-        result = prompts_col.delete_one({"_id": personality_name})
+        deleted = await repo.delete_prompt(personality_name)
         
-        if result.deleted_count > 0:
+        if deleted:
             await update.message.reply_text(
                 f"Successfully deleted custom prompt '{personality_name}' from the database."
             )
@@ -466,6 +3583,116 @@ async def admin_delete_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Error in admin_delete_prompt: {e}")
         await update.message.reply_text(f"An error occurred while deleting: {e}")
 
+def _rendered_length(text: str) -> int:
+    """Length Telegram counts for an HTML message: tags stripped, entities decoded."""
+    return len(html.unescape(re.sub(r"<[^>]+>", "", text)))
+
+def _format_logs_page(entries: list, title: str):
+    """
+    Builds one page of log lines, stopping before the rendered text reaches
+    TELEGRAM_MESSAGE_LIMIT. Returns (text, shown) so the "Next page" keyset
+    starts after the last entry actually shown.
+    """
+    lines = [f"<b>{html.escape(title)}</b>"]
+    length = _rendered_length(lines[0])
+    shown = 0
+    for entry in entries:
+        timestamp = entry.get("timestamp")
+        when = timestamp.strftime("%Y-%m-%d %H:%M") if isinstance(timestamp, datetime) else str(timestamp or "?")
+        who = html.escape((entry.get("user_name") or "?")[:40])
+        if entry.get("user_username"):
+            who += f" @{html.escape(entry['user_username'][:32])}"
+        what = html.escape(entry.get("action") or entry.get("message_type") or "message")
+        text = entry.get("message_text") or ""
+        if len(text) > 80:
+            text = text[:80] + "…"
+        line = f"<code>{when}</code> • {who} (<code>{entry.get('user_id')}</code>) • <b>{what}</b>"
+        if text:
+            line += f": {html.escape(text)}"
+        line_length = _rendered_length(line) + 1  # + the joining newline
+        if length + line_length >= TELEGRAM_MESSAGE_LIMIT:
+            break
+        lines.append(line)
+        length += line_length
+        shown += 1
+    if not entries:
+        lines.append("No log entries found.")
+    return "\n".join(lines), shown
+
+def _logs_keyboard(user_id, limit: int, entries: list, has_more: bool):
+    if not has_more or not entries:
+        return None
+    # callback_data is capped at 64 bytes: "logs:<user|->:<limit>:<24-hex ObjectId>"
+    data = f"logs:{user_id if user_id is not None else '-'}:{limit}:{entries[-1]['_id']}"
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Next page ▶", callback_data=data)]])
+
+async def _reply_logs_page(message, user_id, limit: int, before_id: str = None, edit: bool = False):
+    entries, has_more = await repo.fetch_logs_page(user_id, before_id, limit)
+    title = f"Activity logs for user {user_id}" if user_id is not None else "Recent activity logs"
+    text, shown = _format_logs_page(entries, title)
+    keyboard = _logs_keyboard(user_id, limit, entries[:shown], has_more or shown < len(entries))
+    if edit:
+        await message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
+    else:
+        await message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
+
+def _page_size(args: list, index: int) -> int:
+    try:
+        return max(1, min(int(args[index]), LOG_MAX_PAGE_SIZE))
+    except (IndexError, ValueError):
+        return LOG_PAGE_SIZE
+
+@track_latency("admin_logs")
+async def admin_logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    if not is_db_connected():
+        await update.message.reply_text("Error: Database is not connected.")
+        return
+    try:
+        await _reply_logs_page(update.message, None, _page_size(context.args, 0))
+    except Exception as e:
+        logger.error(f"Error in admin_logs_command: {e}")
+        await update.message.reply_text("Error fetching logs.")
+
+@track_latency("admin_user_logs")
+async def admin_user_logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    if not is_db_connected():
+        await update.message.reply_text("Error: Database is not connected.")
+        return
+    try:
+        user_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Usage: /admin_user_logs <user_id> [page_size]")
+        return
+    try:
+        await _reply_logs_page(update.message, user_id, _page_size(context.args, 1))
+    except Exception as e:
+        logger.error(f"Error in admin_user_logs_command: {e}")
+        await update.message.reply_text("Error fetching logs.")
+
+@track_latency("logs_page")
+async def logs_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles the "Next page" button under /admin_logs and /admin_user_logs."""
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer("You do not have permission to do this.", show_alert=True)
+        return
+    try:
+        _, user_part, limit, before_id = query.data.split(":")
+        user_id = None if user_part == "-" else int(user_part)
+        await query.answer()
+        await _reply_logs_page(query.message, user_id, int(limit), before_id, edit=True)
+    except Exception as e:
+        logger.error(f"Error in logs_page_callback: {e}")
+        await query.answer("Could not load the next page.")
+
+
+@track_latency("broadcast")
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("You do not have permission to use this command.")
@@ -491,27 +3718,425 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("I can only broadcast text or a photo with a caption.")
         return
     try:
-        user_cursor = users_col.find({}, {"_id": 1})
-        user_ids = [doc["_id"] for doc in user_cursor]
-        total_users = len(user_ids)
+        job_id = await broadcast_engine.start(
+            context.bot, text_to_send, photo_to_send, caption_to_send, update.effective_user.id
+        )
+    except Exception as e:
+        logger.error(f"Failed to start broadcast: {e}")
+        await update.message.reply_text(f"Failed to start broadcast: {e}")
+        return
+    await update.message.reply_text(
+        f"Broadcast <code>{job_id}</code> started in the background.\n"
+        f"Check progress with <code>/broadcast_status {job_id}</code>",
+        parse_mode=ParseMode.HTML,
+    )
+
+
+@track_latency("broadcast_status")
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    if not is_db_connected():
+        await update.message.reply_text("Error: Database is not connected.")
+        return
+    try:
+        if context.args:
+            job = await repo.get_broadcast_job(context.args[0])
+            jobs = [job] if job else []
+        else:
+            jobs = await repo.get_broadcast_jobs(5)
     except Exception as e:
-        logger.error(f"Failed to fetch user list for broadcast: {e}")
-        await update.message.reply_text(f"Failed to fetch user list: {e}")
+        logger.error(f"Error in broadcast_status_command: {e}")
+        await update.message.reply_text("Usage: /broadcast_status [job_id]")
+        return
+    if not jobs:
+        await update.message.reply_text("No broadcasts found.")
+        return
+    lines = ["<b>Broadcasts</b>"]
+    for job in jobs:
+        done = job.get("sent", 0) + job.get("failed", 0) + job.get("removed", 0)
+        lines.append(
+            f"• <code>{job['_id']}</code> - <b>{job.get('status')}</b>: "
+            f"{done}/{job.get('total_estimate', '?')} processed "
+            f"({job.get('sent', 0)} sent, {job.get('failed', 0)} failed, {job.get('removed', 0)} removed)"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+@track_latency("admin_profile")
+async def admin_profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/admin_profile [handler] — profile the next request (to that handler) and send the report."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text(
+            "You do not have permission to use this command."
+        )
+        return
+    handler_name = context.args[0] if context.args else "*"
+    if handler_name != "*" and handler_name not in handler_latency:
+        known = ", ".join(sorted(handler_latency)) or "none yet"
+        await update.message.reply_text(f"Unknown handler. Seen so far: {known}")
         return
-    await update.message.reply_text(f"Starting broadcast to {total_users} users... This may take a while.")
-    success_count = 0
-    failure_count = 0
-    for user_id_str in user_ids:
+    request_profiler.arm(handler_name)
+    target = "the next request" if handler_name == "*" else f"the next {handler_name} request"
+    await update.message.reply_text(f"Profiler armed for {target}. The report will be sent here.")
+
+
+# --- APPLICATION FACTORY ---
+def build_application() -> Application:
+    """Creates the python-telegram-bot Application used by the webhook ingestor."""
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .updater(None)  # updates arrive through the Flask webhook
+        .concurrent_updates(True)
+    )
+    if TELEGRAM_API_BASE_URL:
+        base = TELEGRAM_API_BASE_URL.rstrip("/")
+        builder = builder.base_url(f"{base}/bot").base_file_url(f"{base}/file/bot")
+    application = builder.build()
+    application.add_handler(CommandHandler("admin", admin_panel))
+    application.add_handler(CommandHandler("admin_stats", admin_stats_command))
+    application.add_handler(CommandHandler("block", block_command))
+    application.add_handler(CommandHandler("unblock", unblock_command))
+    application.add_handler(CommandHandler("admin_get_prompt", admin_get_prompt))
+    application.add_handler(CommandHandler("admin_set_prompt", admin_set_prompt))
+    application.add_handler(CommandHandler("admin_delete_prompt", admin_delete_prompt))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(r"^/broadcast"), broadcast_command))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
+    application.add_handler(CommandHandler("admin_profile", admin_profile_command))
+    application.add_handler(CommandHandler("admin_logs", admin_logs_command))
+    application.add_handler(CommandHandler("admin_user_logs", admin_user_logs_command))
+    application.add_handler(CallbackQueryHandler(logs_page_callback, pattern=r"^logs:"))
+    application.add_handler(ChatMemberHandler(track_force_join_membership, ChatMemberHandler.CHAT_MEMBER))
+    application.add_error_handler(error_handler)
+    return application
+
+
+# --- WEBHOOK INGESTION (persistent loop + bounded queue) ---
+class WebhookIngestor:
+    """
+    Owns one long-lived event loop per gunicorn worker, running in a daemon
+    thread, and the Application that lives on it.
+
+    The Flask route only validates the update JSON and hands it to submit(),
+    which de-duplicates on update_id (so Telegram retries are harmless) and
+    puts it into a bounded, thread-safe queue without waiting; the put either
+    succeeds or the route answers 503, so an acknowledged update is never
+    dropped. A consumer on the loop turns queued JSON into Update objects and
+    processes up to WEBHOOK_CONCURRENCY of them at a time.
+
+    If startup fails, the route answers 503 until the retry backoff passes;
+    the next submit() then starts a fresh loop thread and tries again.
+    """
+
+    def __init__(self, application_factory):
+        self.application_factory = application_factory
+        self.application = None
+        self.loop = None
+        self.queue = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._start_lock = threading.Lock()
+        self._startup_error = None
+        self._retry_delay = WEBHOOK_STARTUP_RETRY_MIN
+        self._retry_at = 0.0
+        self._stopped = False
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self._slots = None
+        self._consumer = None
+        self._in_flight = set()
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected_full = 0
+        self.processed = 0
+        self.failed = 0
+        self.queue_wait = LatencyHistogram()  # enqueue -> picked up by the consumer
+        self.update_latency = LatencyHistogram()  # process_update duration
+
+    # --- Lifecycle ---
+    def start(self, timeout: float = 30) -> bool:
+        with self._start_lock:
+            if (
+                self._thread is not None and self._startup_error is not None
+                and not self._stopped and time.monotonic() >= self._retry_at
+            ):
+                # The failed loop thread has exited; start over with a fresh one.
+                self._thread = None
+                self._ready = threading.Event()
+                self._startup_error = None
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run_loop, name="telegram-loop", daemon=True)
+                self._thread.start()
+            ready = self._ready
+        ready.wait(timeout)
+        return ready.is_set() and self._startup_error is None
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
         try:
-            user_id = int(user_id_str)
-            if user_id == ADMIN_USER_ID:
-                success_count += 1
+            self.loop.run_until_complete(self._startup())
+        except Exception as e:
+            logger.error(f"Telegram application failed to start, retrying in {self._retry_delay:g}s: {e}")
+            try:
+                if self.application is not None:
+                    self.loop.run_until_complete(self.application.shutdown())
+            except Exception as shutdown_error:
+                logger.error(f"Error cleaning up after failed startup: {shutdown_error}")
+            self.loop.close()
+            with self._start_lock:
+                self._retry_at = time.monotonic() + self._retry_delay
+                self._retry_delay = min(self._retry_delay * 2, WEBHOOK_STARTUP_RETRY_MAX)
+                self._startup_error = e
+            self._ready.set()
+            return
+        self._retry_delay = WEBHOOK_STARTUP_RETRY_MIN
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def _startup(self):
+        self.queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+        self.application = self.application_factory()
+        await self.application.initialize()
+        await self.application.start()
+        self._consumer = asyncio.create_task(self._consume())
+        await self._on_started()
+        logger.info("Telegram application started on the persistent event loop.")
+
+    async def _on_started(self):
+        """Background services that belong to the worker's event loop."""
+        log_sink.start(self.application.bot)
+        _spawn_background(broadcast_engine.run_resumer(self.application.bot))
+        _spawn_background(run_stats_reconciler())
+        try:
+            await run_db("ensure_log_indexes", ensure_log_indexes)
+        except Exception as e:
+            logger.error(f"Error creating chat_logs indexes: {e}")
+        try:
+            await run_db("ensure_membership_indexes", ensure_membership_indexes)
+        except Exception as e:
+            logger.error(f"Error creating membership_cache indexes: {e}")
+
+    async def _shutdown(self, drain_timeout: float):
+        deadline = time.monotonic() + drain_timeout
+        while (
+            not self.queue.empty() or self._in_flight or any(chat_scheduler.pending.values())
+        ) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await log_sink.close()
+        await self.application.stop()
+        await self.application.shutdown()
+        await gemini_client.aclose()
+
+    def stop(self, drain_timeout: float = 10):
+        """Drains queued updates, then shuts the Application and loop down."""
+        if self.loop is None or not self._ready.is_set() or self._startup_error is not None or self._stopped:
+            return
+        self._stopped = True  # atexit calls this again after an explicit stop()
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(drain_timeout), self.loop)
+        try:
+            future.result(drain_timeout + 10)
+        except Exception as e:
+            logger.error(f"Error shutting down Telegram application: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # --- Ingestion (called from Flask request threads) ---
+    def _remember(self, update_id: int) -> bool:
+        """Returns False if update_id was already seen."""
+        with self._seen_lock:
+            if update_id in self._seen:
+                return False
+            self._seen[update_id] = None
+            while len(self._seen) > WEBHOOK_DEDUP_SIZE:
+                self._seen.popitem(last=False)
+            return True
+
+    def _forget(self, update_id: int):
+        with self._seen_lock:
+            self._seen.pop(update_id, None)
+
+    def submit(self, payload) -> str:
+        """Returns "queued", "duplicate", "full", "invalid" or "unavailable"."""
+        if not isinstance(payload, dict) or not isinstance(payload.get("update_id"), int):
+            return "invalid"
+        if not self.start():
+            return "unavailable"
+        update_id = payload["update_id"]
+        if not self._remember(update_id):
+            self.duplicates += 1
+            return "duplicate"
+        try:
+            self.queue.put_nowait((payload, time.perf_counter()))
+        except queue.Full:
+            # Let Telegram retry it later instead of buffering without bound.
+            self._forget(update_id)
+            self.rejected_full += 1
+            return "full"
+        self.loop.call_soon_threadsafe(self._wakeup.set)
+        self.accepted += 1
+        return "queued"
+
+    # --- Processing (on the loop) ---
+    async def _consume(self):
+        while True:
+            try:
+                payload, queued_at = self.queue.get_nowait()
+            except queue.Empty:
+                self._wakeup.clear()
+                if self.queue.empty():  # re-check: a put may have landed before the clear
+                    await self._wakeup.wait()
                 continue
-            if text_to_send:
-                await context.bot.send_message(chat_id=user_id, text=text_to_send)
-            elif photo_to_send:
-                await context.bot.send_photo(chat_id=user_id, photo=photo_to_send, caption=caption_to_send)
-            success_count += 1
-        except Forbidden:
-            logger.warning(f"Broadcast failed for user {user_id}: Bot was blocked.")
-          
+            await self._slots.acquire()
+            self.queue_wait.observe(time.perf_counter() - queued_at)
+            task = asyncio.create_task(self._process(payload))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _process(self, payload: dict):
+        started = time.perf_counter()
+        try:
+            update = Update.de_json(payload, self.application.bot)
+            await self.application.process_update(update)
+            self.processed += 1
+            self.update_latency.observe(time.perf_counter() - started)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error processing update {payload.get('update_id')}: {e}")
+        finally:
+            self._slots.release()
+            self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "in_flight": len(self._in_flight),
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rejected_full": self.rejected_full,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+
+webhook_ingestor = WebhookIngestor(build_application)
+atexit.register(webhook_ingestor.stop)
+
+
+# --- FLASK WEBHOOK ROUTE ---
+# Register on the Flask app with: app.register_blueprint(webhook_bp)
+webhook_bp = Blueprint("webhook", __name__)
+
+@webhook_bp.route("/webhook", methods=["POST"])
+def telegram_webhook():
+    """Validates and enqueues the update, then acknowledges immediately."""
+    if WEBHOOK_SECRET_TOKEN and flask_request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+        return "Forbidden", 403
+    status = webhook_ingestor.submit(flask_request.get_json(silent=True))
+    if status == "invalid":
+        return "Bad Request", 400
+    if status in ("full", "unavailable"):
+        # Non-2xx makes Telegram redeliver later; update_id dedup keeps that safe.
+        return "Busy", 503
+    return "OK", 200
+
+
+# --- PROMETHEUS METRICS ---
+def _prom_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prom_labels(**labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_prom_escape(value)}"' for key, value in labels.items()) + "}"
+
+def _prom_histogram(lines: list, metric: str, histogram: LatencyHistogram, **labels):
+    buckets, count, total = histogram.cumulative()
+    for bound, running in buckets:
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{metric}_bucket{_prom_labels(**labels, le=le)} {running}")
+    lines.append(f"{metric}_sum{_prom_labels(**labels)} {total}")
+    lines.append(f"{metric}_count{_prom_labels(**labels)} {count}")
+
+def render_metrics() -> str:
+    """Prometheus text exposition of the in-process histograms, counters and queue depths."""
+    lines = []
+
+    def family(metric: str, kind: str, help_text: str):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+
+    family("ananya_handler_seconds", "histogram", "End-to-end Telegram handler latency.")
+    for name, histogram in sorted(handler_latency.items()):
+        _prom_histogram(lines, "ananya_handler_seconds", histogram, handler=name)
+
+    family("ananya_gemini_seconds", "histogram", "Gemini call latency per model, retries included.")
+    for model, histogram in sorted(gemini_latency.items()):
+        _prom_histogram(lines, "ananya_gemini_seconds", histogram, model=model)
+    family("ananya_gemini_ttft_seconds", "histogram", "Time to the first streamed Gemini token.")
+    _prom_histogram(lines, "ananya_gemini_ttft_seconds", gemini_ttft)
+    family("ananya_gemini_tokens_total", "counter", "Gemini tokens reported in usageMetadata.")
+    for model, totals in sorted(gemini_client.tokens.items()):
+        for token_type, value in totals.items():
+            lines.append(f"ananya_gemini_tokens_total{_prom_labels(model=model, type=token_type)} {value}")
+    gemini_stats = gemini_client.stats()
+    for counter in ("calls", "retries", "errors"):
+        family(f"ananya_gemini_{counter}_total", "counter", f"Gemini {counter} per endpoint kind.")
+        for kind, value in sorted(gemini_stats[counter].items()):
+            lines.append(f"ananya_gemini_{counter}_total{_prom_labels(kind=kind)} {value}")
+
+    family("ananya_db_op_seconds", "histogram", "Time spent inside a DB helper on the executor.")
+    for name, histogram in sorted(db_op_latency.items()):
+        _prom_histogram(lines, "ananya_db_op_seconds", histogram, op=name)
+    family("ananya_db_queue_wait_seconds", "histogram", "Wait for a free DB executor thread.")
+    _prom_histogram(lines, "ananya_db_queue_wait_seconds", db_queue_latency)
+    family("ananya_mongo_command_seconds", "histogram", "pymongo command latency from the command listener.")
+    for name, histogram in sorted(mongo_commands.latency.items()):
+        _prom_histogram(lines, "ananya_mongo_command_seconds", histogram, command=name)
+    family("ananya_mongo_command_failures_total", "counter", "Failed pymongo commands.")
+    for name, value in sorted(mongo_commands.failures.items()):
+        lines.append(f"ananya_mongo_command_failures_total{_prom_labels(command=name)} {value}")
+    family("ananya_db_available", "gauge", "1 while the DB circuit breaker lets requests through.")
+    lines.append(f"ananya_db_available {int(is_db_connected())}")
+
+    family("ananya_queue_depth", "gauge", "Items waiting in in-process queues.")
+    ingestor_stats = webhook_ingestor.stats()
+    write_behind_stats = write_behind.stats()
+    log_sink_stats = log_sink.stats()
+    depths = {
+        "webhook": ingestor_stats["queue_depth"],
+        "webhook_in_flight": ingestor_stats["in_flight"],
+        "write_behind_users": write_behind_stats["pending_users"],
+        "write_behind_logs": write_behind_stats["pending_logs"],
+        "log_channel": log_sink_stats["pending_errors"] + log_sink_stats["pending_events"],
+        "db_executor": db_executor._work_queue.qsize(),
+    }
+    for kind, pending in chat_scheduler.pending.items():
+        depths[f"scheduler_{kind}"] = pending
+    for queue_name, depth in depths.items():
+        lines.append(f"ananya_queue_depth{_prom_labels(queue=queue_name)} {depth}")
+    family("ananya_update_seconds", "histogram", "Time to process one Telegram update.")
+    _prom_histogram(lines, "ananya_update_seconds", webhook_ingestor.update_latency)
+    family("ananya_update_queue_wait_seconds", "histogram", "Time an update waited in the webhook queue.")
+    _prom_histogram(lines, "ananya_update_queue_wait_seconds", webhook_ingestor.queue_wait)
+    family("ananya_webhook_updates_total", "counter", "Webhook updates by outcome.")
+    for outcome in ("accepted", "duplicates", "rejected_full", "processed", "failed"):
+        lines.append(f"ananya_webhook_updates_total{_prom_labels(outcome=outcome)} {ingestor_stats[outcome]}")
+    return "\n".join(lines) + "\n"
+
+
+# --- FLASK METRICS ROUTE ---
+# Register on the Flask app with: app.register_blueprint(metrics_bp)
+metrics_bp = Blueprint("metrics", __name__)
+
+@metrics_bp.route("/metrics", methods=["GET"])
+def metrics():
+    if METRICS_TOKEN and flask_request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "Forbidden", 403
+    response = make_response(render_metrics())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
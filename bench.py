@@ -0,0 +1,672 @@
+"""
+Offline load test / benchmark for app.py.
+
+Boots the bot against local stand-ins: a fake Telegram Bot API, a fake Gemini
+API (configurable latency, SSE streaming and 429s), and mongomock or a local
+mongod. It then replays a stream of updates through the real /webhook route
+at a target rate and reports throughput, latency percentiles, DB work per
+update and memory.
+
+    python bench.py --updates 2000 --rate 200
+    python bench.py --replay updates.jsonl --mongo-uri mongodb://localhost:27017
+    python bench.py --ci --max-p95-ms 250 --min-throughput 100
+    python bench.py --ci --max-handler-p95-ms chat=2500 --max-handler-p95-ms say=4000
+
+Percentiles come from the app's LatencyHistogram buckets (the same numbers
+/metrics exposes), so they are bucket upper bounds; averages are exact.
+The full result is also written as JSON to bench_output.txt.
+"""
+
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_TOKEN = "123456:BENCH"
+ADMIN_ID = 1
+WEBHOOK_SECRET = "bench-secret"
+
+
+# --- FAKE TELEGRAM BOT API ---
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Answers Bot API methods with minimal valid objects and counts the calls."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _params(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        if "application/json" in content_type:
+            return json.loads(body or b"{}")
+        if "multipart/form-data" in content_type:
+            fields = re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', body)
+            return {name.decode(): value.decode(errors="replace") for name, value in fields}
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # File downloads: /file/bot<token>/<file_path>
+        self.server.record("download")
+        self._send(200, self.server.photo_bytes, "image/jpeg")
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        params = self._params()
+        self.server.record(method)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        result = self.server.result_for(method, params)
+        self._send(200, json.dumps({"ok": True, "result": result}).encode())
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float):
+        super().__init__(("127.0.0.1", 0), FakeTelegramHandler)
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.photo_bytes = _jpeg_bytes(1280, 960)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def record(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+
+    def _message(self, params: dict) -> dict:
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = int(params.get("chat_id") or 0)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": params.get("text", ""),
+        }
+
+    def result_for(self, method: str, params: dict):
+        file_ref = {"file_id": f"file{self._message_id}", "file_unique_id": f"u{self._message_id}"}
+        if method == "getMe":
+            return {"id": 999, "is_bot": True, "first_name": "Ananya", "username": "bench_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method in ("sendMessage", "editMessageText", "copyMessage"):
+            return self._message(params)
+        if method == "sendVoice":
+            return dict(self._message(params), voice=dict(file_ref, duration=3))
+        if method == "sendAudio":
+            return dict(self._message(params), audio=dict(file_ref, duration=3))
+        if method == "sendPhoto":
+            return dict(self._message(params), photo=[dict(file_ref, width=1024, height=1024)])
+        if method == "sendDocument":
+            return dict(self._message(params), document=file_ref)
+        if method == "getFile":
+            return dict(file_ref, file_size=len(self.photo_bytes), file_path="photos/bench.jpg")
+        if method == "getChatMember":
+            user_id = int(params.get("user_id") or 0)
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+        return True
+
+
+# --- FAKE GEMINI API ---
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    """generateContent / streamGenerateContent with latency, SSE chunks and 429s."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        path = urlparse(self.path).path
+        model, _, action = path.rsplit("/", 1)[-1].partition(":")
+        server.record(f"{model}:{action}")
+        if random.random() < server.error_rate:
+            server.record("429")
+            body = b'{"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}'
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        time.sleep(max(0.0, random.gauss(server.latency, server.latency / 4)))
+        if action == "streamGenerateContent":
+            self._stream()
+            return
+        body = json.dumps(server.response_for(model)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self):
+        server = self.server
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = server.reply_text.split(" ")
+        step = max(1, len(words) // server.stream_chunks)
+        for i in range(0, len(words), step):
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": " ".join(words[i:i + step]) + " "}]}}]}
+            if i + step >= len(words):
+                chunk["usageMetadata"] = server.usage
+            data = f"data: {json.dumps(chunk)}\r\n\r\n".encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+            time.sleep(server.chunk_delay)
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float, chunk_delay: float, stream_chunks: int, error_rate: float):
+        super().__init__(("127.0.0.1", 0), FakeGeminiHandler)
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.stream_chunks = stream_chunks
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.tts_model = None
+        self.image_model = None
+        self.reply_text = " ".join(["This is a benchmark reply from the fake Gemini server."] * 6)
+        self.usage = {"promptTokenCount": 420, "candidatesTokenCount": 80, "totalTokenCount": 500}
+        self.audio_b64 = base64.b64encode(bytes(24000 * 2)).decode()  # 1s of silent 24kHz PCM
+        self.image_b64 = base64.b64encode(_jpeg_bytes(1024, 1024)).decode()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def record(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+
+    def response_for(self, model: str) -> dict:
+        if model == self.tts_model:
+            part = {"inlineData": {"mimeType": "audio/L16;rate=24000", "data": self.audio_b64}}
+        elif model == self.image_model:
+            part = {"inlineData": {"mimeType": "image/jpeg", "data": self.image_b64}}
+        else:
+            part = {"text": self.reply_text}
+        return {"candidates": [{"content": {"role": "model", "parts": [part]}}], "usageMetadata": self.usage}
+
+
+def _jpeg_bytes(width: int, height: int) -> bytes:
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (180, 120, 200)).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True).start()
+    return server
+
+
+# --- MONGO STAND-IN ---
+# Collection methods that are one round trip against a real mongod.
+MOCK_COMMAND_METHODS = (
+    "find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+    "delete_one", "delete_many", "find_one_and_update", "find_one_and_replace", "find_one_and_delete",
+    "bulk_write", "count_documents", "estimated_document_count", "aggregate", "distinct",
+    "create_index", "create_indexes",
+)
+
+
+class MockCommandCounter:
+    """Counts mongomock collection calls the way a command listener counts commands."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._depth = threading.local()
+
+    def wrap(self, name: str, method):
+        def counted(collection, *args, **kwargs):
+            # mongomock implements some methods on top of others (find_one -> find);
+            # only the outermost call is a command.
+            depth = getattr(self._depth, "value", 0)
+            if depth == 0:
+                with self._lock:
+                    self.counts[name] += 1
+            self._depth.value = depth + 1
+            try:
+                return method(collection, *args, **kwargs)
+            finally:
+                self._depth.value = depth
+        return counted
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(self.counts.values())
+
+
+def use_mongomock() -> MockCommandCounter:
+    """
+    Routes pymongo.MongoClient to mongomock (must run before app is imported)
+    and returns the counter of collection calls made through it.
+    """
+    try:
+        import mongomock
+        import mongomock.collection
+    except ImportError:
+        sys.exit("mongomock is not installed: pip install mongomock, or pass --mongo-uri.")
+    import pymongo
+
+    class MockClient(mongomock.MongoClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__()  # pool, heartbeat and listener options do not apply
+
+    pymongo.MongoClient = MockClient
+    # pymongo >= 4.11 passes sort= to bulk update builders, which mongomock does not accept.
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+    mongomock.collection.BulkOperationBuilder.add_update = lambda self, *a, sort=None, **kw: add_update(self, *a, **kw)
+
+    counter = MockCommandCounter()
+    for name in MOCK_COMMAND_METHODS:
+        method = getattr(mongomock.collection.Collection, name, None)
+        if method is not None:
+            setattr(mongomock.collection.Collection, name, counter.wrap(name, method))
+    return counter
+
+
+# --- BENCH HANDLERS ---
+def add_bench_handlers(app, application):
+    """
+    app.py does not ship the chat, photo, /say and /gen_image handlers yet.
+    These stand-ins wire the same helpers those handlers use (scheduler,
+    write-behind logging, streaming chat, vision preprocessing, TTS and the
+    portrait pool) so the default mix exercises the real hot paths.
+    """
+    from telegram.ext import CommandHandler, MessageHandler, filters
+
+    def audit(update, action: str, message_type: str, text: str = None):
+        app.log_user(update.effective_user)
+        app.log_activity(update.effective_user, update.effective_chat.id, action, message_type, text)
+
+    @app.scheduled("auto")
+    @app.track_latency("chat")
+    async def chat(update, context):
+        message = update.effective_message
+        text = message.text or message.caption or ""
+        parts = [await app.prepare_vision_part(message.photo)] if message.photo else []
+        if text:
+            parts.append({"text": text})
+        audit(update, "message", "photo" if message.photo else "text", text)
+        await app.stream_chat_reply(
+            message, update.effective_chat.id, {"role": "user", "parts": parts}, app.get_personality_prompt("default"),
+        )
+
+    @app.scheduled("tts")
+    @app.track_latency("say")
+    async def say(update, context):
+        text = " ".join(context.args)
+        audit(update, "command", "say", text)
+        await app.reply_with_speech(update.effective_message, text)
+
+    @app.scheduled("image")
+    @app.track_latency("gen_image")
+    async def gen_image(update, context):
+        audit(update, "command", "gen_image")
+        await app.portrait_pool.reply_portrait(update.effective_message)
+
+    application.add_handler(CommandHandler("say", say))
+    application.add_handler(CommandHandler("gen_image", gen_image))
+    application.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.PHOTO, chat))
+    return application
+
+
+# --- WORKLOAD ---
+DEFAULT_MIX = "text=70,photo=10,say=8,gen_image=4,admin=8"
+ADMIN_COMMANDS = ("/admin_stats", "/broadcast_status", "/admin_logs 5")
+
+def parse_mix(spec: str) -> list:
+    weights = []
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        weights.append((kind.strip(), float(weight or 1)))
+    return weights
+
+def _message(update_id: int, user_id: int, text: str = None, **extra) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            command = text.split(" ", 1)[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    message.update(extra)
+    return {"update_id": update_id, "message": message}
+
+def make_update(kind: str, update_id: int, user_id: int) -> dict:
+    if kind == "text":
+        return _message(update_id, user_id, random.choice(["hi!", "how are you today?", "tell me a joke", "what's up"]))
+    if kind == "photo":
+        sizes = [
+            {"file_id": f"p{update_id}_{w}", "file_unique_id": f"p{update_id}_{w}", "width": w, "height": w * 3 // 4}
+            for w in (90, 320, 800, 1280)
+        ]
+        return _message(update_id, user_id, photo=sizes, caption="what is in this picture?")
+    if kind == "say":
+        # A few repeats, so the media cache's file_id hits show up too.
+        return _message(update_id, user_id, f"/say Hello there! This is benchmark sentence {random.randrange(50)}. And a second one.")
+    if kind == "gen_image":
+        return _message(update_id, user_id, "/gen_image")
+    if kind == "admin":
+        return _message(update_id, ADMIN_ID, random.choice(ADMIN_COMMANDS))
+    if kind == "broadcast":
+        return _message(update_id, ADMIN_ID, "/broadcast Benchmark broadcast, please ignore.")
+    raise ValueError(f"Unknown update kind: {kind}")
+
+def synthetic_updates(count: int, users: int, mix: list, broadcasts: int):
+    kinds, weights = zip(*mix)
+    broadcast_at = {int(count * (i + 1) / (broadcasts + 1)) for i in range(broadcasts)}
+    for i in range(count):
+        kind = "broadcast" if i in broadcast_at else random.choices(kinds, weights)[0]
+        yield kind, make_update(kind, 10_000 + i, 1_000 + random.randrange(users))
+
+def replayed_updates(path: str, count: int):
+    """Recorded Update JSON, one per line; update_ids are renumbered so repeats aren't de-duplicated."""
+    with open(path) as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    for i in range(count or len(recorded)):
+        payload = dict(recorded[i % len(recorded)], update_id=10_000 + i)
+        yield "replay", payload
+
+
+# --- RUN ---
+def _percentiles(histogram) -> dict:
+    snapshot = histogram.snapshot()
+    return {key: round(value, 2) if isinstance(value, float) else value for key, value in snapshot.items()}
+
+def _rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run(args) -> dict:
+    random.seed(args.seed)
+    telegram = _serve(FakeTelegramServer(args.telegram_latency_ms / 1000))
+    gemini = _serve(FakeGeminiServer(
+        args.gemini_latency_ms / 1000, args.gemini_chunk_delay_ms / 1000, args.gemini_stream_chunks, args.gemini_429_rate,
+    ))
+
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_BASE_URL": telegram.url,
+        "GEMINI_API_KEY": "bench",
+        "GEMINI_API_BASE": gemini.url,
+        "ADMIN_USER_ID": str(ADMIN_ID),
+        "WEBHOOK_SECRET_TOKEN": WEBHOOK_SECRET,
+        "MONGODB_URI": args.mongo_uri or "mongodb://localhost:27017",
+        "MEDIA_CACHE_DIR": tempfile.mkdtemp(prefix="bench-media-"),
+    })
+    os.environ.setdefault("BROADCAST_RATE_PER_SEC", "1000")
+    os.environ.setdefault("GEMINI_MAX_RETRIES", "3")
+    os.environ.pop("LOG_CHANNEL_ID", None)
+    mock_commands = None if args.mongo_uri else use_mongomock()
+    if args.trace_memory:
+        tracemalloc.start()
+
+    import app  # noqa: E402 (configured through the environment above)
+    from flask import Flask
+
+    logging.getLogger("app").setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    gemini.tts_model = app.GEMINI_TTS_MODEL
+    gemini.image_model = app.GEMINI_IMAGE_MODEL
+    app.webhook_ingestor.application_factory = lambda: add_bench_handlers(app, app.build_application())
+
+    if args.seed_users:
+        app.users_col.insert_many([{"_id": str(100_000 + i), "first_name": f"Seed{i}"} for i in range(args.seed_users)])
+        app.reconcile_stats()
+
+    server = Flask("bench")
+    server.register_blueprint(app.webhook_bp)
+    server.register_blueprint(app.metrics_bp)
+    client = server.test_client()
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+
+    ingestor = app.webhook_ingestor
+    if not ingestor.start():
+        sys.exit(f"Application failed to start: {ingestor._startup_error}")
+
+    if args.replay:
+        updates = list(replayed_updates(args.replay, args.updates))
+    else:
+        updates = list(synthetic_updates(args.updates, args.users, parse_mix(args.mix), args.broadcasts))
+
+    db_calls_before = sum(h.count for h in app.db_op_latency.values())
+    def mongo_command_count() -> int:
+        if mock_commands is not None:
+            return mock_commands.total()
+        return sum(h.count for h in app.mongo_commands.latency.values())
+
+    mongo_before = mongo_command_count()
+    flushes_before = app.write_behind.flushes
+    memory_before = tracemalloc.get_traced_memory()[0] if args.trace_memory else 0
+    statuses = Counter()
+    kinds = Counter()
+    chats = set()
+
+    started = time.perf_counter()
+    for i, (kind, payload) in enumerate(updates):
+        if args.rate:
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        response = client.post("/webhook", json=payload, headers=headers)
+        statuses[response.status_code] += 1
+        kinds[kind] += 1
+        message = payload.get("message") or {}
+        if message.get("chat"):
+            chats.add(message["chat"]["id"])
+    submitted = time.perf_counter()
+
+    deadline = submitted + args.drain_timeout
+    while time.perf_counter() < deadline:
+        stats = ingestor.stats()
+        idle = stats["queue_depth"] == 0 and stats["in_flight"] == 0 and not any(app.chat_scheduler.pending.values())
+        if idle and stats["processed"] + stats["failed"] >= stats["accepted"]:
+            break
+        time.sleep(0.01)
+    finished = time.perf_counter()
+
+    if kinds["broadcast"]:
+        while time.perf_counter() < deadline and any(job["status"] == "running" for job in app.get_broadcast_jobs(20)):
+            time.sleep(0.05)
+    app.write_behind.flush()
+
+    stats = ingestor.stats()
+    processed = stats["processed"] + stats["failed"]
+    elapsed = finished - started
+    db_calls = sum(h.count for h in app.db_op_latency.values()) - db_calls_before
+    mongo_commands = mongo_command_count() - mongo_before
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("ci",)},
+        "updates": dict(kinds),
+        "http_statuses": {str(code): count for code, count in statuses.items()},
+        "accepted": stats["accepted"],
+        "processed": stats["processed"],
+        "failed": stats["failed"],
+        "rejected_full": stats["rejected_full"],
+        "elapsed_s": round(elapsed, 3),
+        "submit_s": round(submitted - started, 3),
+        "throughput_per_s": round(processed / elapsed, 1) if elapsed else 0.0,
+        "update_latency_ms": _percentiles(ingestor.update_latency),
+        "queue_wait_ms": _percentiles(ingestor.queue_wait),
+        "handlers_ms": {name: _percentiles(h) for name, h in sorted(app.handler_latency.items())},
+        "db_helper_calls_per_update": round(db_calls / processed, 3) if processed else 0.0,
+        "write_behind_flushes": app.write_behind.flushes - flushes_before,
+        "mongo_commands_per_update": round(mongo_commands / processed, 3) if processed else 0.0,
+        "mongo_commands_source": "command listener" if args.mongo_uri else "mongomock collection calls",
+        "gemini_calls": dict(gemini.calls),
+        "gemini_client": app.gemini_client.stats(),
+        "telegram_calls": dict(telegram.calls),
+        "active_chats": len(chats),
+        "peak_rss_mb": round(_rss_mb(), 1),
+    }
+    if args.trace_memory:
+        grown = tracemalloc.get_traced_memory()[0] - memory_before
+        result["memory_per_chat_kb"] = round(grown / max(1, len(chats)) / 1024, 2)
+    result["metrics_bytes"] = len(client.get("/metrics").data)
+
+    ingestor.stop(drain_timeout=5)
+    telegram.shutdown()
+    gemini.shutdown()
+    return result
+
+
+def check_thresholds(result: dict, args) -> list:
+    """Returns the CI threshold violations (empty when the run passes)."""
+    violations = []
+    if args.min_throughput is not None and result["throughput_per_s"] < args.min_throughput:
+        violations.append(f"throughput {result['throughput_per_s']}/s < {args.min_throughput}/s")
+    if args.max_p95_ms is not None and result["update_latency_ms"]["p95_ms"] > args.max_p95_ms:
+        violations.append(f"p95 {result['update_latency_ms']['p95_ms']}ms > {args.max_p95_ms}ms")
+    if args.max_avg_ms is not None and result["update_latency_ms"]["avg_ms"] > args.max_avg_ms:
+        violations.append(f"avg {result['update_latency_ms']['avg_ms']}ms > {args.max_avg_ms}ms")
+    if args.max_db_calls is not None and result["db_helper_calls_per_update"] > args.max_db_calls:
+        violations.append(f"DB helper calls/update {result['db_helper_calls_per_update']} > {args.max_db_calls}")
+    if args.max_mongo_commands is not None and result["mongo_commands_per_update"] > args.max_mongo_commands:
+        violations.append(f"mongo commands/update {result['mongo_commands_per_update']} > {args.max_mongo_commands}")
+    # Hot handlers run on the chat scheduler, so update latency only covers
+    # dispatch; these gate the handlers themselves.
+    for key, limits in (("p95_ms", args.max_handler_p95_ms), ("avg_ms", args.max_handler_avg_ms)):
+        for name, limit in limits.items():
+            snapshot = result["handlers_ms"].get(name)
+            if not snapshot or not snapshot["count"]:
+                violations.append(f"handler {name} never ran, cannot check its {key[:-3]}")
+            elif snapshot[key] > limit:
+                violations.append(f"handler {name} {key[:-3]} {snapshot[key]}ms > {limit}ms")
+    if result["failed"] > args.max_failed:
+        violations.append(f"{result['failed']} updates failed (allowed {args.max_failed})")
+    if result["processed"] + result["failed"] < result["accepted"]:
+        violations.append(f"only {result['processed'] + result['failed']} of {result['accepted']} accepted updates finished")
+    return violations
+
+
+def print_report(result: dict):
+    latency = result["update_latency_ms"]
+    print(f"updates:      {sum(result['updates'].values())} {result['updates']}")
+    print(f"processed:    {result['processed']} ok, {result['failed']} failed, {result['rejected_full']} rejected (queue full)")
+    print(f"throughput:   {result['throughput_per_s']} updates/s over {result['elapsed_s']}s")
+    print(f"update time:  avg {latency['avg_ms']}ms  p50 {latency['p50_ms']}ms  p95 {latency['p95_ms']}ms  p99 {latency['p99_ms']}ms")
+    print(f"queue wait:   avg {result['queue_wait_ms']['avg_ms']}ms  p95 {result['queue_wait_ms']['p95_ms']}ms")
+    for name, snapshot in result["handlers_ms"].items():
+        print(f"  {name:<20} n={snapshot['count']:<6} avg {snapshot['avg_ms']}ms  p95 {snapshot['p95_ms']}ms  p99 {snapshot['p99_ms']}ms")
+    print(f"DB:           {result['db_helper_calls_per_update']} helper calls/update, "
+          f"{result['write_behind_flushes']} write-behind flushes, "
+          f"{result['mongo_commands_per_update']} mongo commands/update ({result['mongo_commands_source']})")
+    print(f"Gemini:       {result['gemini_calls']}")
+    print(f"Telegram:     {result['telegram_calls']}")
+    memory = f", {result['memory_per_chat_kb']} KB per active chat" if "memory_per_chat_kb" in result else ""
+    print(f"memory:       peak RSS {result['peak_rss_mb']} MB, {result['active_chats']} active chats{memory}")
+
+
+def _handler_limit(spec: str) -> tuple:
+    """argparse type for NAME=MS."""
+    name, sep, value = spec.partition("=")
+    try:
+        if not sep or not name:
+            raise ValueError
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected HANDLER=MS, got {spec!r}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    workload = parser.add_argument_group("workload")
+    workload.add_argument("--updates", type=int, default=1000, help="updates to send (with --replay: 0 = file length)")
+    workload.add_argument("--rate", type=float, default=200, help="target updates/s (0 = as fast as possible)")
+    workload.add_argument("--users", type=int, default=200, help="distinct synthetic users/chats")
+    workload.add_argument("--mix", default=DEFAULT_MIX, help=f"update kinds and weights (default {DEFAULT_MIX})")
+    workload.add_argument("--broadcasts", type=int, default=0, help="/broadcast commands spread through the run")
+    workload.add_argument("--seed-users", type=int, default=0, help="users inserted up front (broadcast audience)")
+    workload.add_argument("--replay", help="JSONL file of recorded Update payloads")
+    workload.add_argument("--seed", type=int, default=1)
+    fakes = parser.add_argument_group("stand-ins")
+    fakes.add_argument("--mongo-uri", help="use a real mongod instead of mongomock")
+    fakes.add_argument("--telegram-latency-ms", type=float, default=5)
+    fakes.add_argument("--gemini-latency-ms", type=float, default=300)
+    fakes.add_argument("--gemini-chunk-delay-ms", type=float, default=40)
+    fakes.add_argument("--gemini-stream-chunks", type=int, default=6)
+    fakes.add_argument("--gemini-429-rate", type=float, default=0.0, help="share of Gemini calls answered with 429")
+    output = parser.add_argument_group("output")
+    output.add_argument("--output", default="bench_output.txt", help="JSON result file ('' to skip)")
+    output.add_argument("--trace-memory", action="store_true", help="tracemalloc per-chat memory (slower)")
+    output.add_argument("--drain-timeout", type=float, default=120)
+    output.add_argument("--verbose", action="store_true")
+    ci = parser.add_argument_group("CI thresholds (exit 1 when violated)")
+    ci.add_argument("--ci", action="store_true", help="enforce the thresholds below")
+    ci.add_argument("--min-throughput", type=float)
+    ci.add_argument("--max-p95-ms", type=float, help="update dispatch p95 (scheduled handlers run after it)")
+    ci.add_argument("--max-avg-ms", type=float, help="update dispatch average")
+    ci.add_argument("--max-handler-p95-ms", type=_handler_limit, action="append", default=[], metavar="HANDLER=MS",
+                    help="p95 of one handler, e.g. chat=2500 (repeatable)")
+    ci.add_argument("--max-handler-avg-ms", type=_handler_limit, action="append", default=[], metavar="HANDLER=MS",
+                    help="average of one handler (repeatable)")
+    ci.add_argument("--max-db-calls", type=float, help="max DB helper calls per update")
+    ci.add_argument("--max-mongo-commands", type=float, help="max mongo commands per update")
+    ci.add_argument("--max-failed", type=int, default=0)
+    args = parser.parse_args(argv)
+    args.max_handler_p95_ms = dict(args.max_handler_p95_ms)
+    args.max_handler_avg_ms = dict(args.max_handler_avg_ms)
+
+    result = run(args)
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, default=str)
+    if args.ci:
+        violations = check_thresholds(result, args)
+        result["violations"] = violations
+        for violation in violations:
+            print(f"FAIL: {violation}")
+        if violations:
+            return 1
+        print("PASS")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())